@@ -12,35 +12,260 @@ Common data for the assignment
 """
 
 import time
+import json
+import threading
+import random
+import asyncio
+import urllib.parse
 import requests
 
 from cse351 import *
 
+# connections kept open to the server (see HttpClient), set_client() to change
+POOL_SIZE = 100
+
 TOP_API_URL = 'http://127.0.0.1:8790'
 
 
+# ----------------------------------------------------------------------------
+def get_backoff(attempt, backoff, max_backoff, retry_after=None):
+    # seconds to wait before trying again. Full jitter: a random time up to
+    # backoff * 2^attempt, so requests that failed together do not all come
+    # back together. retry_after is the Retry-After header of the reply.
+    delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+    if retry_after != None and retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    return delay
+
+class HttpClient:
+    """
+    Keeps connections to the server open and shares them between threads
+    (requests.Session with a pool of pool_size connections), so a request
+    does not start with a new TCP connection.  Failed requests are tried
+    again after an exponential backoff with jitter.  hook, if given, is
+    called after every attempt with (url, status, seconds), status is None
+    when there was no reply.
+    """
+
+    RETRY_STATUS = (429, 502, 503, 504)     # server busy, worth trying again
+
+    def __init__(self, pool_size=POOL_SIZE, retries=8, backoff=0.01, max_backoff=2.0, timeout=10, hook=None):
+        super().__init__()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.hook = hook
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _wait(self, attempt, retry_after=None):
+        time.sleep(get_backoff(attempt, self.backoff, self.max_backoff, retry_after))
+
+    def _timed(self, url, started, status):
+        if self.hook != None:
+            self.hook(url, status, time.perf_counter() - started)
+
+    def get(self, url):
+        # Returns the json of the reply, None if the request failed
+        for attempt in range(self.retries):
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self._timed(url, started, None)
+                if attempt < self.retries - 1:
+                    self._wait(attempt)
+                continue
+            except requests.exceptions.RequestException:
+                self._timed(url, started, None)
+                return None
+
+            self._timed(url, started, response.status_code)
+            if response.status_code in self.RETRY_STATUS:
+                if attempt < self.retries - 1:
+                    self._wait(attempt, response.headers.get('Retry-After'))
+                continue
+            if response.status_code != 200:
+                return None
+            return response.json()
+
+        print("Max retries reached. Failing.")
+        return None
+
+    def stream(self, url):
+        # the reply as it arrives, for streaming routes
+        return self.session.get(url, timeout=self.timeout, stream=True)
+
+client = None
+client_lock = threading.Lock()
+
+def get_client():
+    global client
+    with client_lock:
+        if client == None:
+            client = HttpClient()
+        return client
+
+def set_client(pool_size=POOL_SIZE, hook=None, **options):
+    # size the pool to the number of threads making requests, call before
+    # starting them
+    global client
+    with client_lock:
+        client = HttpClient(pool_size, hook=hook, **options)
+        return client
+
 # ----------------------------------------------------------------------------
 def get_data_from_server(url):
-    retries = 50
-    delay = 0.01 # seconds
-    for i in range(retries):
+    return get_client().get(url)
+
+# ----------------------------------------------------------------------------
+class AsyncHttpClient:
+    """
+    asyncio version of HttpClient: plain HTTP/1.1 over asyncio streams, so
+    one thread can keep hundreds of requests in flight.  Connections are
+    kept open and reused, at most max_in_flight requests are sent at the
+    same time (the others wait on a semaphore).  Same retries and hook as
+    HttpClient.  Connections and the semaphore belong to one event loop, a
+    request from another loop (a second asyncio.run) starts over with new
+    ones.
+    """
+
+    RETRY_STATUS = HttpClient.RETRY_STATUS
+
+    def __init__(self, max_in_flight=POOL_SIZE, retries=8, backoff=0.01, max_backoff=2.0, timeout=10, hook=None):
+        super().__init__()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.hook = hook
+        self.max_in_flight = max_in_flight
+        self.loop = None        # event loop of the semaphore and connections
+        self.semaphore = None
+        self.idle = {}          # (host, port) -> open connections not in use
+
+    def _use_running_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # connections of an old loop can not be used or even closed
+            # from this one, they are dropped with it
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+            self.idle = {}
+
+    async def _connect(self, host, port):
+        connections = self.idle.setdefault((host, port), [])
+        while len(connections) > 0:
+            reader, writer = connections.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return await asyncio.open_connection(host, port)
+
+    async def _read_body(self, reader, headers):
+        # Returns (body, keep_alive)
+        if headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                data = await reader.readexactly(size + 2)
+                if size == 0:
+                    return body, True
+                body += data[:-2]
+        if 'content-length' in headers:
+            return await reader.readexactly(int(headers['content-length'])), True
+        return await reader.read(), False
+
+    async def _request(self, url):
+        # Returns (status, headers, body)
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        reader, writer = await self._connect(parts.hostname, parts.port or 80)
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            if response.status_code == 200:
-                return response.json()
-            break
-
-        except requests.exceptions.ConnectionError as e:
-            if i < retries - 1:
-                time.sleep(delay)
-            else:
-                print("Max retries reached. Failing.")
-                
-        except requests.exceptions.Timeout:
-            ...
-            
-        except requests.exceptions.RequestException as e:
-            break
-
-    return None
\ No newline at end of file
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n\r\n'.encode())
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if status_line == b'':
+                # the server closed a connection that was kept open
+                raise ConnectionError('Connection closed by the server')
+            status = int(status_line.split()[1])
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            body, keep_alive = await self._read_body(reader, headers)
+        except BaseException:
+            writer.close()
+            raise
+
+        if keep_alive and headers.get('connection', '').lower() != 'close':
+            self.idle[(parts.hostname, parts.port or 80)].append((reader, writer))
+        else:
+            writer.close()
+        return status, headers, body
+
+    def _timed(self, url, started, status):
+        if self.hook != None:
+            self.hook(url, status, time.perf_counter() - started)
+
+    async def get(self, url):
+        # Returns the json of the reply, None if the request failed
+        self._use_running_loop()
+        for attempt in range(self.retries):
+            retry_after = None
+            async with self.semaphore:
+                started = time.perf_counter()
+                try:
+                    status, headers, body = await asyncio.wait_for(self._request(url), self.timeout)
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError):
+                    self._timed(url, started, None)
+                    status = None
+
+                if status != None:
+                    self._timed(url, started, status)
+                    if status not in self.RETRY_STATUS:
+                        if status != 200:
+                            return None
+                        return json.loads(body)
+                    retry_after = headers.get('retry-after')
+
+            # wait outside the semaphore so other requests can go
+            if attempt < self.retries - 1:
+                await asyncio.sleep(get_backoff(attempt, self.backoff, self.max_backoff, retry_after))
+
+        print("Max retries reached. Failing.")
+        return None
+
+    async def close(self):
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idle = {}
+
+async_client = None
+
+def set_async_client(max_in_flight=POOL_SIZE, hook=None, **options):
+    # call from inside the event loop, before the requests start
+    global async_client
+    async_client = AsyncHttpClient(max_in_flight, hook=hook, **options)
+    return async_client
+
+# ----------------------------------------------------------------------------
+async def get_data_from_server_async(url):
+    # asyncio counterpart of get_data_from_server(), for coroutines
+    if async_client == None:
+        set_async_client()
+    return await async_client.get(url)
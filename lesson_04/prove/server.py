@@ -31,13 +31,18 @@ API
 """
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from http import HTTPStatus
 from socketserver import ThreadingMixIn
 import datetime
 import json
 import time
 import random
 import threading
+import queue
+import atexit
+import asyncio
 import ast
+import sys
 
 # Consts
 hostName = "127.0.0.1"
@@ -48,6 +53,24 @@ MAX_GENERATIONS = 6
 
 DATA_FOLDER = 'data/'
 
+# Latency profile, how long a request waits before the reply (see pick_delay)
+# Can also be picked when starting the server: python server.py lognormal
+#   constant  : always SLEEP
+#   uniform   : SLEEP +/- LATENCY_JITTER (a fraction of SLEEP)
+#   lognormal : median SLEEP with a long tail, LATENCY_SIGMA is the spread
+LATENCY_PROFILES = ('constant', 'uniform', 'lognormal')
+LATENCY = 'constant'
+LATENCY_JITTER = 0.5
+LATENCY_SIGMA = 0.5
+LATENCY_ROUTES = {}     # route -> delay in seconds used instead of SLEEP
+                        # (by default only 'record' has a delay)
+LATENCY_KNEE = 0        # > 0: with more than this many requests in flight,
+LATENCY_SLOWDOWN = 0.1  # each extra one adds this fraction of the delay
+
+# True: serve with asyncio (one thread, see serve_async) instead of a thread
+# per request
+ASYNC_SERVER = False
+
 # Global Variables
 max_thread_count = 0
 call_count = 0
@@ -75,238 +98,384 @@ start_time = time.time()
 end_time = time.time()
 
 # ----------------------------------------------------------------------------
+# Log levels, lines above LOG_LEVEL are dropped (and not printed)
+LOG_NONE = 0
+LOG_SUMMARY = 1         # /start and /end details
+LOG_REQUESTS = 2        # a few lines for every request
+LOG_LEVEL = LOG_SUMMARY
+
 class Log:
+    """
+    Lines are put on a queue and written by a background thread, a batch
+    at a time with one flush per batch, so request threads never wait on
+    the file.
+    """
+
+    BATCH = 1000
 
     def __init__(self, filename):
         super().__init__()
-        self.lock = threading.Lock()
         self.filename = filename
         self.file = open(filename, 'w')
-
-    def write(self, line):
-        with self.lock:
-            self.file.write(line)
-            self.file.write('\n')
-            self.file.flush()
+        self.lines = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._write_lines, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def enabled(self, level):
+        return level <= LOG_LEVEL
+
+    def write(self, line, level=LOG_SUMMARY):
+        if level <= LOG_LEVEL:
+            self.lines.put(line)
+
+    def _write_lines(self):
+        done = False
+        while not done:
+            batch = [self.lines.get()]
+            while len(batch) < self.BATCH:
+                try:
+                    batch.append(self.lines.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                done = True
+                batch = batch[:batch.index(None)]
+
+            if len(batch) > 0:
+                self.file.write('\n'.join(batch))
+                self.file.write('\n')
+                self.file.flush()
+
+    def close(self):
+        # write what is queued, then close the file
+        if self.writer.is_alive():
+            self.lines.put(None)
+            self.writer.join()
+        self.file.close()
 
     def __del__(self):
-        self.file.close()
+        self.close()
 
 # Global log object
 log = Log('server.log')
 
 # ----------------------------------------------------------------------------
-class Handler(BaseHTTPRequestHandler):
+def request_started(request):
+    global thread_count
+    global call_count
+    global max_thread_count
+
+    with lock:
+        thread_count += 1
+        call_count += 1
+        if thread_count > max_thread_count:
+            max_thread_count = thread_count
+        counts = (thread_count, max_thread_count)
+
+    if log.enabled(LOG_REQUESTS):
+        print(f'Current: active threads / max count: {counts[0]} / {counts[1]}')
+        print('- ' * 35)
+        print(s := f'Request: {request}')
+        log.write(f'Current: active threads / max count: {counts[0]} / {counts[1]}', LOG_REQUESTS)
+        log.write(s, LOG_REQUESTS)
+
+def request_finished():
+    global thread_count
+
+    with lock:
+        thread_count -= 1
+
+def get_route(request):
+    # same tests as get_reply()
+    for route in ('start', 'end', 'city', 'record'):
+        if route in request:
+            return route
+    return None
+
+def get_delay(request):
+    # only city records are slow, unless LATENCY_ROUTES says otherwise
+    route = get_route(request)
+    base = SLEEP if route == 'record' else 0
+    return pick_delay(LATENCY_ROUTES.get(route, base), thread_count)
+
+def pick_delay(base, in_flight):
+    # delay in seconds for a request, base is the delay for its route
+    if LATENCY == 'uniform':
+        delay = base * random.uniform(1 - LATENCY_JITTER, 1 + LATENCY_JITTER)
+    elif LATENCY == 'lognormal':
+        delay = base * random.lognormvariate(0, LATENCY_SIGMA)
+    else:
+        delay = base
+
+    if LATENCY_KNEE > 0 and in_flight > LATENCY_KNEE:
+        delay *= 1 + LATENCY_SLOWDOWN * (in_flight - LATENCY_KNEE)
+    return delay
+
+def get_reply(request):
+    """
+    Work out the reply to one request (the delay is done by the caller).
+    Returns (200, json text) or (404, None)
+    """
+    global thread_count
+    global max_thread_count
+    global call_count
+
+    # START ---------------------------------------------------
+    if 'start' in request:
+        global start_time
+        global cities_data
+
+        # Load DAT files
+        cities_data = {}
+        for name, filename in CITIES:
+            print(s := f'Loading city data {name}')
+            log.write(s)
+            with open(DATA_FOLDER + filename, 'r') as f:
+                cities_data[name] = json.load(f)
 
-    def get_city_details(self, name):
-        # global people
-        # if id in people:
-        #     return people[id].get_dict()
-        # else:
-        #     return None
-        pass
+        max_thread_count = 1
+        thread_count = 1
+        call_count = 1
 
+        start_time = time.time()
 
-    def get_city_record(self, name, recno):
-        # global families
-        # if id in families:
-        #     return families[id].get_dict()
-        # else:
-        #     return None
-        pass
+        json_data = '{"status":"OK"}'
 
-   
-    def do_GET(self):
-        global thread_count
-        global lock
-        global max_thread_count
-        global call_count
-        global log
-
-        with lock:
-            thread_count += 1
-            call_count += 1
-            if thread_count > max_thread_count:
-                max_thread_count = thread_count
-            print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
-            log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
 
-        print('- ' * 35)
-        print(s := f'Request: {self.path}')
+    # END ---------------------------------------------------
+    elif 'end' in request:
+        global end_time
+
+        end_time = time.time()
+
+        print('#' * 80)
+        log.write('#' * 80)
+
+        print(s := f'Total number of API calls     : {call_count}')
         log.write(s)
 
-        # START ---------------------------------------------------
-        if 'start' in self.path:
-            global start_time
-            global cities_data
+        print(s := f'Final thread count (max count): {max_thread_count}')
+        log.write(s)
 
-            # Load DAT files
-            cities_data = {}
-            for name, filename in CITIES:
-                print(s := f'Loading city data {name}')
-                log.write(s)
-                with open(DATA_FOLDER + filename, 'r') as f:
-                    cities_data[name] = json.load(f)
+        print(s := f'Total time (seconds)          : {end_time - start_time}')
+        log.write(s)
 
-            max_thread_count = 1
-            thread_count = 1
-            call_count = 1
+        print(s := f'Calls per second              : {call_count / (end_time - start_time)}')
+        log.write(s)
 
-            start_time = time.time()
+        data_str = '{' + \
+                   f'"status":"OK", "api": {call_count}, "threads": {max_thread_count}, "total_time": {end_time - start_time}, "calls_per_second": {call_count / (end_time - start_time)}' + \
+                   '}'
+        json_data = json.dumps(ast.literal_eval(data_str))
 
-            json_data = '{"status":"OK"}'
+        print('#' * 80)
+        log.write('#' * 80)
 
+    # CITY DETAILS  ---------------------------------------------------
+    elif 'city' in request:
+        parts = request.split('/')
+        # print('****************************')
+        # print(parts)
 
-        # END ---------------------------------------------------
-        elif 'end' in self.path:
-            global end_time
+        if len(parts) != 3:
+            return 404, None
 
-            end_time = time.time()
+        try:
+            name = parts[-1].lower()
+        except:
+            name = None
 
-            print('#' * 80)
-            log.write('#' * 80)
+        if name == None:
+            return 404, None
 
-            print(s := f'Total number of API calls     : {call_count}')
-            log.write(s)
+        if name not in cities_data:
+            return 404, None
 
-            print(s := f'Final thread count (max count): {max_thread_count}')
-            log.write(s)
+        data_str = '{' + \
+                   f'"status":"OK", "city": "{name}", "records": {len(cities_data[name])}' + \
+                   '}'
+        json_data = json.dumps(ast.literal_eval(data_str))
 
-            print(s := f'Total time (seconds)          : {end_time - start_time}')
-            log.write(s)
+    # CITY RECORD  ---------------------------------------------------
+    elif 'record' in request:
 
-            print(s := f'Calls per second              : {call_count / (end_time - start_time)}')
-            log.write(s)
+        parts = request.split('/')
+        # print('****************************')
+        # print(parts)
 
-            data_str = '{' + \
-                       f'"status":"OK", "api": {call_count}, "threads": {max_thread_count}, "total_time": {end_time - start_time}, "calls_per_second": {call_count / (end_time - start_time)}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
+        if len(parts) != 4:
+            return 404, None
 
-            print('#' * 80)
-            log.write('#' * 80)
+        try:
+            name = parts[-2].lower()
+            record = int(parts[-1])
+        except:
+            name = None
+            record = None
 
-        # CITY DETAILS  ---------------------------------------------------
-        elif 'city' in self.path:
-            parts = self.path.split('/')
-            # print('****************************')
-            # print(parts)
+        if name == None or record == None:
+            return 404, None
 
-            if len(parts) != 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        if name not in cities_data:
+            return 404, None
 
-            try:
-                name = parts[-1].lower()
-            except:
-                name = None
-
-            if name == None:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
-
-            if name not in cities_data:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
-
-            data_str = '{' + \
-                       f'"status":"OK", "city": "{name}", "records": {len(cities_data[name])}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
-
-        # CITY RECORD  ---------------------------------------------------
-        elif 'record' in self.path:
-
-            if SLEEP > 0:
-                time.sleep(SLEEP)
-
-            parts = self.path.split('/')
-            # print('****************************')
-            # print(parts)
-
-            if len(parts) != 4:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        date_str = cities_data[name][record][0]         # Format "mmdd hhmmss"
+        temp = cities_data[name][record][1]
 
-            try:
-                name = parts[-2].lower()
-                record = int(parts[-1])
-            except:
-                name = None
-                record = None
-
-            if name == None or record == None:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
-
-            if name not in cities_data:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
-
-            date_str = cities_data[name][record][0]         # Format "mmdd hhmmss"
-            temp = cities_data[name][record][1]
-
-            # Expand date string to "mm-dd hh:mm:ss"
-            #         01234567890
-            # format "mmdd hhmmss"
-            date_str = date_str[:2] + '-' + date_str[2:4] + ' ' + date_str[5:7] + ':' + date_str[7:9] + ':' + date_str[9:]
-
-            data_str = '{' + \
-                       f'"status":"OK", "city": "{name}", "date": "{date_str}", "temp": {temp}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
-
-        else:
-            json_data = None
-
-
-        if json_data == None:
-            self.send_response(404)
-            self.send_header("Content-type",  "application/json")
-            self.end_headers()
-        else:
-            print('Sending:', json_data)
-            log.write(f'Sending: {json_data}')
+        # Expand date string to "mm-dd hh:mm:ss"
+        #         01234567890
+        # format "mmdd hhmmss"
+        date_str = date_str[:2] + '-' + date_str[2:4] + ' ' + date_str[5:7] + ':' + date_str[7:9] + ':' + date_str[9:]
+
+        data_str = '{' + \
+                   f'"status":"OK", "city": "{name}", "date": "{date_str}", "temp": {temp}' + \
+                   '}'
+        json_data = json.dumps(ast.literal_eval(data_str))
+
+    else:
+        json_data = None
+
+
+    if json_data == None:
+        return 404, None
+
+    if log.enabled(LOG_REQUESTS):
+        print('Sending:', json_data)
+        log.write(f'Sending: {json_data}', LOG_REQUESTS)
+
+    return 200, json_data
 
-            self.send_response(200)
+# ----------------------------------------------------------------------------
+class Handler(BaseHTTPRequestHandler):
+
+    # HTTP/1.1 keeps the connection open so clients can reuse it, every reply
+    # needs a Content-Length for that to work
+    protocol_version = 'HTTP/1.1'
+
+    # headers and body go out as separate writes, with Nagle on the body of
+    # a reply on a kept-alive connection waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        request_started(self.path)
+        try:
+            delay = get_delay(self.path)
+            if delay > 0:
+                time.sleep(delay)
+
+            status, json_data = get_reply(self.path)
+
+            body = b'' if json_data == None else bytes(json_data, "utf8")
+            self.send_response(status)
             self.send_header("Content-type",  "application/json")
+            self.send_header("Content-Length",  str(len(body)))
             self.end_headers()
-            self.wfile.write(bytes(json_data, "utf8"))
+            self.wfile.write(body)
+        finally:
+            request_finished()
 
-        with lock:
-            thread_count -= 1
+    def log_request(self, code='-', size='-'):
+        # the default prints a line to stderr for every request, errors
+        # (log_error) still go to stderr
+        if isinstance(code, HTTPStatus):
+            code = code.value
+        log.write(f'"{self.requestline}" {code} {size}', LOG_REQUESTS)
 
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+    # idle keep-alive connections should not stop the server from exiting
+    daemon_threads = True
+
+
+# ----------------------------------------------------------------------------
+# asyncio server: same routes as Handler, but every connection is a task on
+# one event loop and SLEEP is an asyncio.sleep, so thousands of requests can
+# wait at the same time without a thread each.
+
+async def read_request(reader):
+    # Returns (method, path, version, keep_alive), None when the client closed
+    request_line = await reader.readline()
+    if request_line == b'':
+        return None
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+
+    parts = request_line.decode('latin-1').split()
+    while len(parts) < 3:
+        parts.append('HTTP/1.0')
+    method, path, version = parts[:3]
+
+    # HTTP/1.1 keeps the connection open unless told not to, HTTP/1.0 the opposite
+    if version == 'HTTP/1.1':
+        keep_alive = headers.get('connection') != 'close'
+    else:
+        keep_alive = headers.get('connection') == 'keep-alive'
+
+    return method, path, version, keep_alive
+
+async def handle_connection(reader, writer):
+    try:
+        keep_alive = True
+        while keep_alive:
+            request = await read_request(reader)
+            if request == None:
+                break
+
+            method, path, version, keep_alive = request
+            if method != 'GET':
+                await send_async(writer, 400, None, False)
+                break
+
+            request_started(path)
+            try:
+                delay = get_delay(path)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                status, json_data = get_reply(path)
+                await send_async(writer, status, json_data, keep_alive)
+            finally:
+                request_finished()
+
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def send_async(writer, status, json_data, keep_alive):
+    body = b'' if json_data == None else bytes(json_data, "utf8")
+    head = f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+    head += 'Content-type: application/json\r\n'
+    head += f'Content-Length: {len(body)}\r\n'
+    head += f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+    writer.write(head.encode() + body)
+    await writer.drain()
+
+async def serve_async():
+    server = await asyncio.start_server(handle_connection, hostName, serverPort, backlog=1024)
+    async with server:
+        await server.serve_forever()
 
 
 if __name__ == '__main__':
-    server = ThreadingSimpleServer((hostName, serverPort), Handler)
+    if len(sys.argv) > 1:
+        if sys.argv[1] not in LATENCY_PROFILES:
+            print(f'Unknown latency profile {sys.argv[1]}, use one of {LATENCY_PROFILES}')
+            sys.exit(1)
+        LATENCY = sys.argv[1]
+
     print(f'Starting server.  Waiting on {hostName}:{serverPort}, use <Ctrl-C> or <Command-C> to stop')
-    server.serve_forever()
+    if ASYNC_SERVER:
+        asyncio.run(serve_async())
+    else:
+        server = ThreadingSimpleServer((hostName, serverPort), Handler)
+        server.serve_forever()
 
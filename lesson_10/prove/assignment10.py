@@ -7,19 +7,20 @@ Purpose: Assignment 10 - Family Search
 """
 
 from common import *     # brings in TOP_API_URL, Tree, get_data_from_server
-from functions import depth_fs_pedigree, breadth_fs_pedigree, breadth_fs_pedigree_limit5
+from functions import depth_fs_pedigree, breadth_fs_pedigree, breadth_fs_pedigree_limit5, breadth_fs_pedigree_async, single_flight
 from cse351 import *     # brings in Log, print_dict, etc.
 
 
 DFS = "Depth First Search"
 BFS = "Breadth First Search"
 BFS5 = "Breadth First Search limit 5"
+BFS_ASYNC = "Breadth First Search asyncio"
 
 
 def run_part(log, start_id, generations, title, func):
     """Runs a single DFS/BFS search using the given function."""
     
-    tree = Tree(start_id)
+    tree = ConcurrentTree(start_id)
 
     # Tell the server to generate a new random family tree
     get_data_from_server(f"{TOP_API_URL}/start/{generations}")
@@ -30,6 +31,7 @@ def run_part(log, start_id, generations, title, func):
     log.write("#" * 45)
 
     # Run the DFS or BFS function you wrote in functions.py
+    single_flight.reset()
     func(start_id, tree)
 
     total_time = log.stop_timer()
@@ -51,6 +53,7 @@ def run_part(log, start_id, generations, title, func):
     log.write(f"Families:   {tree.get_family_count():>10,} | {server_data['families']:>14,}")
     log.write(f"API Calls            : {server_data['api']}")
     log.write(f"Max number of threads: {server_data['threads']}")
+    log.write(f"Coalesced API calls  : {single_flight.coalesced}")
 
 
 def main():
@@ -74,6 +77,8 @@ def main():
                 run_part(log, start_id, generations, BFS, breadth_fs_pedigree)
             elif part == 3:
                 run_part(log, start_id, generations, BFS5, breadth_fs_pedigree_limit5)
+            elif part == 4:
+                run_part(log, start_id, generations, BFS_ASYNC, breadth_fs_pedigree_async)
 
 
 if __name__ == "__main__":
@@ -6,48 +6,292 @@ Author: Samantha Mayes
 Don't change this code.  You are not submitting it with your assignment
 
 """
+import sys
 import time
+import threading
+import json
+import random
+import asyncio
+import urllib.parse
 import requests
 from cse351 import *
 
+# connections kept open to the server (see HttpClient), set_client() to change
+POOL_SIZE = 100
+
 TOP_API_URL = 'http://127.0.0.1:8123'
 
+# ----------------------------------------------------------------------------
+def get_backoff(attempt, backoff, max_backoff, retry_after=None):
+    # seconds to wait before trying again. Full jitter: a random time up to
+    # backoff * 2^attempt, so requests that failed together do not all come
+    # back together. retry_after is the Retry-After header of the reply.
+    delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+    if retry_after != None and retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    return delay
+
+class HttpClient:
+    """
+    Keeps connections to the server open and shares them between threads
+    (requests.Session with a pool of pool_size connections), so a request
+    does not start with a new TCP connection.  Failed requests are tried
+    again after an exponential backoff with jitter.  hook, if given, is
+    called after every attempt with (url, status, seconds), status is None
+    when there was no reply.
+    """
+
+    RETRY_STATUS = (429, 502, 503, 504)     # server busy, worth trying again
+
+    def __init__(self, pool_size=POOL_SIZE, retries=8, backoff=0.01, max_backoff=2.0, timeout=10, hook=None):
+        super().__init__()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.hook = hook
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _wait(self, attempt, retry_after=None):
+        time.sleep(get_backoff(attempt, self.backoff, self.max_backoff, retry_after))
+
+    def _timed(self, url, started, status):
+        if self.hook != None:
+            self.hook(url, status, time.perf_counter() - started)
+
+    def get(self, url):
+        # Returns the json of the reply, None if the request failed
+        for attempt in range(self.retries):
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self._timed(url, started, None)
+                if attempt < self.retries - 1:
+                    self._wait(attempt)
+                continue
+            except requests.exceptions.RequestException:
+                self._timed(url, started, None)
+                return None
+
+            self._timed(url, started, response.status_code)
+            if response.status_code in self.RETRY_STATUS:
+                if attempt < self.retries - 1:
+                    self._wait(attempt, response.headers.get('Retry-After'))
+                continue
+            if response.status_code != 200:
+                return None
+            return response.json()
+
+        print("Max retries reached. Failing.")
+        return None
+
+    def stream(self, url):
+        # the reply as it arrives, for streaming routes
+        return self.session.get(url, timeout=self.timeout, stream=True)
+
+client = None
+client_lock = threading.Lock()
+
+def get_client():
+    global client
+    with client_lock:
+        if client == None:
+            client = HttpClient()
+        return client
+
+def set_client(pool_size=POOL_SIZE, hook=None, **options):
+    # size the pool to the number of threads making requests, call before
+    # starting them
+    global client
+    with client_lock:
+        client = HttpClient(pool_size, hook=hook, **options)
+        return client
+
 # ----------------------------------------------------------------------------
 def get_data_from_server(url):
-    retries = 50
-    delay = 0.01 # seconds
-    for i in range(retries):
+    return get_client().get(url)
+
+# ----------------------------------------------------------------------------
+class AsyncHttpClient:
+    """
+    asyncio version of HttpClient: plain HTTP/1.1 over asyncio streams, so
+    one thread can keep hundreds of requests in flight.  Connections are
+    kept open and reused, at most max_in_flight requests are sent at the
+    same time (the others wait on a semaphore).  Same retries and hook as
+    HttpClient.  Connections and the semaphore belong to one event loop, a
+    request from another loop (a second asyncio.run) starts over with new
+    ones.
+    """
+
+    RETRY_STATUS = HttpClient.RETRY_STATUS
+
+    def __init__(self, max_in_flight=POOL_SIZE, retries=8, backoff=0.01, max_backoff=2.0, timeout=10, hook=None):
+        super().__init__()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.hook = hook
+        self.max_in_flight = max_in_flight
+        self.loop = None        # event loop of the semaphore and connections
+        self.semaphore = None
+        self.idle = {}          # (host, port) -> open connections not in use
+
+    def _use_running_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # connections of an old loop can not be used or even closed
+            # from this one, they are dropped with it
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+            self.idle = {}
+
+    async def _connect(self, host, port):
+        connections = self.idle.setdefault((host, port), [])
+        while len(connections) > 0:
+            reader, writer = connections.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return await asyncio.open_connection(host, port)
+
+    async def _read_body(self, reader, headers):
+        # Returns (body, keep_alive)
+        if headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                data = await reader.readexactly(size + 2)
+                if size == 0:
+                    return body, True
+                body += data[:-2]
+        if 'content-length' in headers:
+            return await reader.readexactly(int(headers['content-length'])), True
+        return await reader.read(), False
+
+    async def _request(self, url):
+        # Returns (status, headers, body)
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        reader, writer = await self._connect(parts.hostname, parts.port or 80)
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            if response.status_code == 200:
-                return response.json()
-            break
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n\r\n'.encode())
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if status_line == b'':
+                # the server closed a connection that was kept open
+                raise ConnectionError('Connection closed by the server')
+            status = int(status_line.split()[1])
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            body, keep_alive = await self._read_body(reader, headers)
+        except BaseException:
+            writer.close()
+            raise
+
+        if keep_alive and headers.get('connection', '').lower() != 'close':
+            self.idle[(parts.hostname, parts.port or 80)].append((reader, writer))
+        else:
+            writer.close()
+        return status, headers, body
+
+    def _timed(self, url, started, status):
+        if self.hook != None:
+            self.hook(url, status, time.perf_counter() - started)
+
+    async def get(self, url):
+        # Returns the json of the reply, None if the request failed
+        self._use_running_loop()
+        for attempt in range(self.retries):
+            retry_after = None
+            async with self.semaphore:
+                started = time.perf_counter()
+                try:
+                    status, headers, body = await asyncio.wait_for(self._request(url), self.timeout)
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError):
+                    self._timed(url, started, None)
+                    status = None
+
+                if status != None:
+                    self._timed(url, started, status)
+                    if status not in self.RETRY_STATUS:
+                        if status != 200:
+                            return None
+                        return json.loads(body)
+                    retry_after = headers.get('retry-after')
+
+            # wait outside the semaphore so other requests can go
+            if attempt < self.retries - 1:
+                await asyncio.sleep(get_backoff(attempt, self.backoff, self.max_backoff, retry_after))
+
+        print("Max retries reached. Failing.")
+        return None
+
+    async def close(self):
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idle = {}
+
+async_client = None
+
+def set_async_client(max_in_flight=POOL_SIZE, hook=None, **options):
+    # call from inside the event loop, before the requests start
+    global async_client
+    async_client = AsyncHttpClient(max_in_flight, hook=hook, **options)
+    return async_client
 
-        except requests.exceptions.ConnectionError as e:
-            if i < retries - 1:
-                time.sleep(delay)
-            else:
-                print("Max retries reached. Failing.")
-                
-        except requests.exceptions.Timeout:
-            ...
-            
-        except requests.exceptions.RequestException as e:
-            break
+# ----------------------------------------------------------------------------
+async def get_data_from_server_async(url):
+    # asyncio counterpart of get_data_from_server(), for coroutines
+    if async_client == None:
+        set_async_client()
+    return await async_client.get(url)
 
-    return None
+# ----------------------------------------------------------------------------
+def stream_data_from_server(url):
+    # Generator for routes that reply with one JSON object per line
+    # (e.g. /pedigree). Items are returned as they arrive.
+    try:
+        with get_client().stream(url) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    except requests.exceptions.RequestException as e:
+        print(f'Stream failed: {e}')
 
 # ----------------------------------------------------------------------------
 class Person:
 
+    # no __dict__ per person, a big tree holds many of them
+    __slots__ = ('__id', '__name', '__parents', '__family', '__birth')
+
     def __init__(self, data):
         super().__init__()
         self.__id = data['id']
-        self.__name = data['name']
+        # names and birth dates repeat across a tree, keep one copy of each
+        self.__name = sys.intern(data['name'])
         self.__parents = data['parent_id']
         self.__family = data['family_id']
-        self.__birth = data['birth']
+        self.__birth = sys.intern(data['birth'])
 
     def __str__(self):
         output  = f'id        : {self.__id}\n'
@@ -76,12 +320,14 @@ class Person:
 # ----------------------------------------------------------------------------
 class Family:
 
+    __slots__ = ('__id', '__husband', '__wife', '__children')
+
     def __init__(self, data):
         super().__init__()
         self.__id = data['id']
         self.__husband = data['husband_id']
         self.__wife = data['wife_id']
-        self.__children = data['children']
+        self.__children = tuple(data['children'])
 
     def children_count(self):
         return len(self.__children)
@@ -116,17 +362,28 @@ class Tree:
         self.__families = {}
         self.__start_family_id = start_family_id
 
+        # Statistics of the families connected to the start family (through
+        # the parents of husbands and wives), kept up to date as records are
+        # added so display() does not walk the tree
+        self.__generations = {}         # family id -> generation, 0 = start family
+        self.__generation_counts = []   # generation -> number of families
+        self.__connected = set()        # people connected to the start family
+        self.__waiting_families = {}    # family id not in the tree yet -> its generation
+        self.__waiting_spouses = {}     # spouse id not in the tree yet -> generation of the family
+
     def add_person(self, person):
         if self.does_person_exist(person.get_id()):
             print(f'ERROR: Person with ID = {person.get_id()} Already exists in the tree')
         else:
             self.__people[person.get_id()] = person
+            self._person_added(person)
 
     def add_family(self, family):
         if self.does_family_exist(family.get_id()):
             print(f'ERROR: Family with ID = {family.get_id()} Already exists in the tree')
         else:
             self.__families[family.get_id()] = family
+            self._family_added(family)
 
     def get_person(self, id):
         if id in self.__people:
@@ -152,119 +409,210 @@ class Tree:
     def does_family_exist(self, id):
         return id in self.__families
 
-    def display(self, log):
-        log.write('\n\n')
-        log.write(f'{" TREE DISPLAY ":*^40}')
-        for family_id in self.__families:
-            fam = self.__families[family_id]
+    def add_person_if_absent(self, person):
+        # Returns the person now in the tree: person, or the one added first
+        if not self.does_person_exist(person.get_id()):
+            self.__people[person.get_id()] = person
+            self._person_added(person)
+        return self.__people[person.get_id()]
 
-            log.write(f'Family id: {family_id}')
+    def add_family_if_absent(self, family):
+        # Returns the family now in the tree: family, or the one added first
+        if not self.does_family_exist(family.get_id()):
+            self.__families[family.get_id()] = family
+            self._family_added(family)
+        return self.__families[family.get_id()]
+
+    def get_generation_counts(self):
+        # number of families connected to the start family, per generation
+        return list(self.__generation_counts)
+
+    def _waits_for_person(self, id):
+        # True if adding this person can change the statistics
+        return id in self.__waiting_spouses
+
+    def _waits_for_family(self, id):
+        # True if adding this family can change the statistics
+        return id == self.__start_family_id or id in self.__waiting_families
+
+    def _person_added(self, person):
+        # a husband or wife of a connected family, their parents are next
+        generation = self.__waiting_spouses.pop(person.get_id(), None)
+        if generation is not None:
+            self.__connected.add(person.get_id())
+            self._connect(person.get_parentid(), generation + 1)
+
+    def _family_added(self, family):
+        if family.get_id() == self.__start_family_id:
+            self._connect(family.get_id(), 0)
+        elif family.get_id() in self.__waiting_families:
+            self._connect(family.get_id(), self.__waiting_families.pop(family.get_id()))
+
+    def _connect(self, family_id, generation):
+        # Add family_id and the families above it that are already in the tree
+        # to the statistics. Without recursion, so deep trees are fine.
+        stack = [(family_id, generation)]
+        while len(stack) > 0:
+            family_id, generation = stack.pop()
+            if family_id is None or family_id == 0 or family_id in self.__generations:
+                continue
+
+            family = self.__families.get(family_id)
+            if family is None:
+                self.__waiting_families[family_id] = generation
+                # look again, ConcurrentTree may have added it since without
+                # seeing it wait
+                family = self.__families.get(family_id)
+                if family is None:
+                    continue
+                del self.__waiting_families[family_id]
+
+            self.__generations[family_id] = generation
+            while len(self.__generation_counts) <= generation:
+                self.__generation_counts.append(0)
+            self.__generation_counts[generation] += 1
+            self.__connected.update(family.get_children())
+
+            for spouse_id in (family.get_husband(), family.get_wife()):
+                spouse = self.__people.get(spouse_id)
+                if spouse is None and spouse_id is not None and spouse_id != 0:
+                    self.__waiting_spouses[spouse_id] = generation
+                    # look again, as for the families above
+                    spouse = self.__people.get(spouse_id)
+                    if spouse is not None:
+                        del self.__waiting_spouses[spouse_id]
+                if spouse is not None:
+                    self.__connected.add(spouse_id)
+                    stack.append((spouse.get_parentid(), generation + 1))
+
+    DISPLAY_CHUNK = 1000        # family lines per write in display()
+
+    def display(self, log, filename=None, summary_only=False):
+        """
+        Write every family, then the statistics, to log.  The family lines
+        are written DISPLAY_CHUNK lines at a time.  With a filename they go
+        only to that file (the statistics still go to log), summary_only
+        writes just the statistics.
+        """
+        if not summary_only:
+            title = f'{" TREE DISPLAY ":*^40}'
+            if filename is None:
+                log.write('\n\n')
+                log.write(title)
+                for chunk in self._display_chunks():
+                    log.write(chunk)
+            else:
+                with open(filename, 'w') as f:
+                    f.write(title + '\n')
+                    for chunk in self._display_chunks():
+                        f.write(chunk + '\n')
+
+        log.write('')
+        log.write(f'Number of people                    : {len(self.__people)}')
+        log.write(f'Number of families                  : {len(self.__families)}')
+        log.write(f'Max generations                     : {self._count_generations(self.__start_family_id)}')
+        log.write(f'People connected to starting family : {self._test_number_connected_to_start()}')
+        log.write(f'Families per generation             : {self.get_generation_counts()}')
+
+
+    def _display_chunks(self):
+        # display lines joined DISPLAY_CHUNK at a time
+        lines = []
+        for line in self._display_lines():
+            lines.append(line)
+            if len(lines) == self.DISPLAY_CHUNK:
+                yield '\n'.join(lines)
+                lines = []
+        if len(lines) > 0:
+            yield '\n'.join(lines)
+
+    def _display_parents(self, person):
+        parent_fam = self.get_family(person.get_parentid())
+        if parent_fam == None:
+            return 'None'
+        father = self.get_person(parent_fam.get_husband())
+        mother = self.get_person(parent_fam.get_wife())
+        return f'{father.get_name()} and {mother.get_name()}'
+
+    def _display_lines(self):
+        for family_id, fam in self.__families.items():
+            yield f'Family id: {family_id}'
 
-            # Husband
             husband = self.get_person(fam.get_husband())
+            wife = self.get_person(fam.get_wife())
+
             if husband == None:
-                log.write(f'  Husband: None')
+                yield '  Husband: None'
             else:
-                log.write(f'  Husband: {husband.get_name()}, {husband.get_birth()}')
+                yield f'  Husband: {husband.get_name()}, {husband.get_birth()}'
 
-            # wife
-            wife = self.get_person(fam.get_wife())
             if wife == None:
-                log.write(f'  Wife: None')
+                yield '  Wife: None'
             else:
-                log.write(f'  Wife: {wife.get_name()}, {wife.get_birth()}')
+                yield f'  Wife: {wife.get_name()}, {wife.get_birth()}'
 
-            # Parents of Husband
             if husband == None:
-                log.write(f'  Husband Parents: None')
+                yield '  Husband Parents: None'
             else:
-                parent_fam_id = husband.get_parentid()
-                if parent_fam_id in self.__families:
-                    parent_fam = self.get_family(parent_fam_id)
-                    father = self.get_person(parent_fam.get_husband())
-                    mother = self.get_person(parent_fam.get_wife())
-                    log.write(f'  Husband Parents: {father.get_name()} and {mother.get_name()}')
-                else:
-                    log.write(f'  Husband Parents: None')
-
-            # Parents of Wife
+                yield f'  Husband Parents: {self._display_parents(husband)}'
+
             if wife == None:
-                log.write(f'  Wife Parents: None')
+                yield '  Wife Parents: None'
             else:
-                parent_fam_id = wife.get_parentid()
-                if parent_fam_id in self.__families:
-                    parent_fam = self.get_family(parent_fam_id)
-                    father = self.get_person(parent_fam.get_husband())
-                    mother = self.get_person(parent_fam.get_wife())
-                    log.write(f'  Wife Parents: {father.get_name()} and {mother.get_name()}')
-                else:
-                    log.write(f'  Wife Parents: None')
-
-            # children
-            output = []
-            for index, child_id in enumerate(fam.get_children()):
-                person = self.__people[child_id]
-                output.append(f'{person.get_name()}')
-            out_str = str(output).replace("'", '', 100)
-            log.write(f'  Children: {out_str[1:-1]}')
-
-        log.write('')
-        log.write(f'Number of people                    : {len(self.__people)}')
-        log.write(f'Number of families                  : {len(self.__families)}')
-        log.write(f'Max generations                     : {self._count_generations(self.__start_family_id)}')
-        log.write(f'People connected to starting family : {self._test_number_connected_to_start()}')
+                yield f'  Wife Parents: {self._display_parents(wife)}'
 
+            names = ', '.join(self.__people[child_id].get_name() for child_id in fam.get_children())
+            yield f'  Children: {names}'
 
     def _test_number_connected_to_start(self):
-        # start with first family, how many connected to that family
-        inds_seen = set()
-
-        def _recurive(family_id):
-            nonlocal inds_seen
-            if family_id in self.__families:
-                # count people in this family
-                fam = self.__families[family_id]
-
-                husband = self.get_person(fam.get_husband())
-                if husband != None:
-                    if husband.get_id() not in inds_seen:
-                        inds_seen.add(husband.get_id())
-                    _recurive(husband.get_parentid())
-                
-                wife = self.get_person(fam.get_wife())
-                if wife != None:
-                    if wife.get_id() not in inds_seen:
-                        inds_seen.add(wife.get_id())
-                    _recurive(wife.get_parentid())
-
-                for child_id in fam.get_children():
-                    if child_id not in inds_seen:
-                        inds_seen.add(child_id)
-
-
-        _recurive(self.__start_family_id)
-        return len(inds_seen)
-
+        # people in the families connected to the start family (kept by _connect)
+        return len(self.__connected)
 
     def _count_generations(self, family_id):
-        max_gen = -1
-
-        def _recurive_gen(id, gen):
-            nonlocal max_gen
-            if id in self.__families:
-                if max_gen < gen:
-                    max_gen = gen
-
-                fam = self.__families[id]
+        # number of generations above the start family (kept by _connect)
+        if family_id != self.__start_family_id:
+            return 0
+        return len(self.__generation_counts)
 
-                husband = self.get_person(fam.get_husband())
-                if husband != None:
-                    _recurive_gen(husband.get_parentid(), gen + 1)
-                
-                wife = self.get_person(fam.get_wife())
-                if wife != None:
-                    _recurive_gen(wife.get_parentid(), gen + 1)
 
-        _recurive_gen(family_id, 0)
-        return max_gen + 1
+# -----------------------------------------------------------------------------
+class ConcurrentTree(Tree):
+    """
+    Tree that many threads can fill without a lock of their own.  Lookups
+    are plain dict reads.  add_person_if_absent / add_family_if_absent check
+    and insert in one step under one of STRIPES locks picked by the id, so
+    threads adding different ids seldom wait for each other.  The
+    statistics are shared by all ids and updated under one lock, but only
+    after inserts that can change them (an id the statistics wait for).
+    """
+
+    STRIPES = 64
 
+    def __init__(self, start_family_id):
+        super().__init__(start_family_id)
+        self.__locks = [threading.Lock() for _ in range(self.STRIPES)]
+        self.__stats_lock = threading.Lock()
+
+    def _lock(self, id):
+        return self.__locks[hash(id) % self.STRIPES]
+
+    def add_person_if_absent(self, person):
+        with self._lock(person.get_id()):
+            return super().add_person_if_absent(person)
+
+    def add_family_if_absent(self, family):
+        with self._lock(family.get_id()):
+            return super().add_family_if_absent(family)
+
+    # The check without the lock is safe: the record is in the dict before
+    # the check, and _connect looks at the dict again after it makes an id
+    # wait, so one of the two sees the other.
+    def _person_added(self, person):
+        if self._waits_for_person(person.get_id()):
+            with self.__stats_lock:
+                super()._person_added(person)
+
+    def _family_added(self, family):
+        if self._waits_for_family(family.get_id()):
+            with self.__stats_lock:
+                super()._family_added(family)
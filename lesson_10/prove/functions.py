@@ -47,7 +47,7 @@ Describe how to speed up part 1
 For part 1 I would still use a rescursive depth first search over the family graph, but I would speed it up by:
 -Feching the Family record once per family ID using a visited set
 -For each family, fetching the husband, wife, and all children in parallel using multiple threads. Each thread calls the Person API for one person.
-- Protecting the shared Tree object with a single lock when adding people and families so the dictionary updates are thread safe.
+- Adding people and families with the tree's add_person_if_absent / add_family_if_absent (ConcurrentTree), which check and insert in one step without a global lock.
 The recursion order is still DFS, I recurse from the a family to the parents of the husband and wife, but each family's people are retrieved concurrently so that multiple 0.25-second API calls overlap 
 intead of happening one at a time.
 
@@ -59,9 +59,9 @@ For part 2 (BFS) I implement a **breadth-first search** using a
 `queue.Queue` of family IDs. I add the starting family to the queue, and
 then run a pool of worker threads (for example, 20 workers). Each worker:
 - Takes the next family ID from the queue.
-- Calls the Family API, adds that Family to the Tree, then fetches the
-  husband, wife, and all children (sequentially, but in parallel with
-  other workers).
+- Calls the Family API with `?expand=members`, which returns the family
+  together with the husband, wife, and all children, and adds all of
+  them to the Tree (one call per family instead of one per person).
 - Looks up the parents of the husband and wife and enqueues their
   parent family IDs if they haven’t been visited yet.
 A shared `visited_families` set (with a lock) prevents duplicate work.
@@ -85,9 +85,53 @@ busy as long as there is more work to do.
 from common import *
 import queue
 import threading
+import asyncio
 
 
-def _fetch_family(family_id, tree, tree_lock):
+class SingleFlight:
+    """
+    Server calls that are still out, by (kind, encoded id).  A thread that
+    wants a record another thread is already getting waits for that call
+    instead of making its own, coalesced counts those saved calls.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.calls = {}         # key -> [Event set when done, result]
+        self.coalesced = 0
+
+    def get(self, key, fetch):
+        # Returns fetch(), called by only one of the threads asking for key
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = [threading.Event(), None]
+                self.calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call[0].wait()
+            return call[1]
+
+        try:
+            call[1] = fetch()
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+        return call[1]
+
+    def reset(self):
+        with self.lock:
+            self.coalesced = 0
+
+single_flight = SingleFlight()
+
+
+def _fetch_family(family_id, tree):
     """
     Fetch a Family from the server and store it in the tree (if not already).
     Returns the Family object or None if not found.
@@ -95,25 +139,26 @@ def _fetch_family(family_id, tree, tree_lock):
     if family_id is None or family_id == 0:
         return None
 
-    # If we already have this family, return it directly.
-    with tree_lock:
-        if tree.does_family_exist(family_id):
-            return tree.get_family(family_id)
+    def fetch():
+        # look again, another call may have finished since
+        family = tree.get_family(family_id)
+        if family is not None:
+            return family
 
-    data = get_data_from_server(f'{TOP_API_URL}/family/{family_id}')
-    if data is None:
-        return None
-
-    family = Family(data)
+        data = get_data_from_server(f'{TOP_API_URL}/family/{family_id}')
+        if data is None:
+            return None
 
-    with tree_lock:
-        if not tree.does_family_exist(family.get_id()):
-            tree.add_family(family)
+        # print(f'Fetched family {data["id"]}')   # helpful for debugging
+        return tree.add_family_if_absent(Family(data))
 
-    # print(f'Fetched family {family.get_id()}')   # helpful for debugging
-    return family
+    # If we already have this family, return it directly.
+    family = tree.get_family(family_id)
+    if family is not None:
+        return family
+    return single_flight.get(('family', family_id), fetch)
 
-def _fetch_person(person_id, tree, tree_lock):
+def _fetch_person(person_id, tree):
     """
     Fetch a Person from the server and store it in the tree (if not already).
     Returns the Person object or None if not found.
@@ -121,24 +166,220 @@ def _fetch_person(person_id, tree, tree_lock):
     if person_id is None or person_id == 0:
         return None
 
+    def fetch():
+        person = tree.get_person(person_id)
+        if person is not None:
+            return person
+
+        data = get_data_from_server(f'{TOP_API_URL}/person/{person_id}')
+        if data is None:
+            return None
+
+        # print(f'Fetched person {data["id"]}')   # helpful for debugging
+        return tree.add_person_if_absent(Person(data))
+
     # If we already have this person, return it directly.
-    with tree_lock:
-        if tree.does_person_exist(person_id):
-            return tree.get_person(person_id)
+    person = tree.get_person(person_id)
+    if person is not None:
+        return person
+    return single_flight.get(('person', person_id), fetch)
 
-    data = get_data_from_server(f'{TOP_API_URL}/person/{person_id}')
-    if data is None:
+def _fetch_family_with_members(family_id, tree):
+    """
+    Fetch a Family with its husband, wife and children inlined
+    (/family/{id}?expand=members) and store all of them in the tree.
+    One server call instead of one per person.
+    Returns the Family object or None if not found.
+    """
+    if family_id is None or family_id == 0:
         return None
 
-    person = Person(data)
+    def cached():
+        # the family only counts if its people are in the tree too, a plain
+        # _fetch_family may have added it without them
+        family = tree.get_family(family_id)
+        if family is None:
+            return None
+        for person_id in (family.get_husband(), family.get_wife()) + family.get_children():
+            if person_id and tree.get_person(person_id) is None:
+                return None
+        return family
+
+    def fetch():
+        family = cached()
+        if family is not None:
+            return family
+
+        data = get_data_from_server(f'{TOP_API_URL}/family/{family_id}?expand=members')
+        if data is None:
+            return None
+
+        members = data['members']
+        for person_data in [members['husband'], members['wife']] + members['children']:
+            if person_data is not None:
+                tree.add_person_if_absent(Person(person_data))
+
+        return tree.add_family_if_absent(Family(data))
+
+    family = cached()
+    if family is not None:
+        return family
+    # not the key of _fetch_family, a plain family fetch must not stand in
+    # for this one
+    return single_flight.get(('family+members', family_id), fetch)
+
+def _fetch_pedigree(family_id, tree, depth=0):
+    """
+    Fill the tree from the /pedigree stream: the whole ancestor subtree of
+    family_id (depth generations, 0 = all) in a single server call.
+    Returns the number of records added.
+    """
+    added = 0
+    url = f'{TOP_API_URL}/pedigree/{family_id}?depth={depth}'
+    for data in stream_data_from_server(url):
+        if data['type'] == 'family':
+            item = Family(data)
+            if tree.add_family_if_absent(item) is item:
+                added += 1
+        else:
+            item = Person(data)
+            if tree.add_person_if_absent(item) is item:
+                added += 1
+
+    return added
+
+
+PREFETCH_FAMILIES = False   # see _FamilyPrefetch, faster but the families are
+                            # no longer requested in depth first order
+PREFETCH_THREADS = 4        # threads that make the prefetch requests
+
+class _FamilyPrefetch:
+    """
+    Speculative prefetch: as soon as a husband or wife record arrives, the
+    family of their parents (parent_id) is requested in the background, so
+    it is usually in the tree before the search gets to it.  The requests
+    are made by PREFETCH_THREADS threads that take the ids from a queue.
+    A family is prefetched once, seen is the dedup set.  A search that gets
+    to a family still being prefetched waits for that call (single_flight).
+    """
+
+    def __init__(self, tree, seen=()):
+        super().__init__()
+        self.tree = tree
+        self.lock = threading.Lock()
+        self.seen = set(seen)
+        self.work = queue.Queue()
+        self.threads = []
+        if PREFETCH_FAMILIES:
+            for _ in range(PREFETCH_THREADS):
+                t = threading.Thread(target=self._worker)
+                t.start()
+                self.threads.append(t)
+
+    def _worker(self):
+        while True:
+            fid = self.work.get()
+            if fid is None:
+                break
+            _fetch_family(fid, self.tree)
+
+    def reveal_parents(self, spouse):
+        if spouse is None or not PREFETCH_FAMILIES:
+            return
+
+        fid = spouse.get_parentid()
+        if fid is None or fid == 0:
+            return
+        with self.lock:
+            if fid in self.seen:
+                return
+            self.seen.add(fid)
+        self.work.put(fid)
+
+    def join(self):
+        # the ids already queued are fetched before the threads stop
+        for _ in self.threads:
+            self.work.put(None)
+        for t in self.threads:
+            t.join()
+
+
+DFS_POOL_SIZE = 0       # > 0: depth_fs_pedigree uses a pool of this many threads
+                        # (see _depth_fs_pool), much faster but the families are
+                        # requested about breadth first.  0: a new thread for
+                        # every person, depth first order
+
+def _depth_fs_pool(family_id, tree, pool_size):
+    """
+    The search of depth_fs_pedigree on a fixed pool of threads that live for
+    the whole search.  The work is a LIFO stack, but a free thread takes a
+    family as soon as it is found, so the families are requested in about
+    the order they are found: about breadth first, not depth first.  A
+    family's parents go on the stack as soon as the husband or wife record
+    arrives.
+    """
+    visited_lock = threading.Lock()
+    visited_families = {family_id}
+    work = queue.LifoQueue()
+
+    def add_family(fid):
+        if fid is None or fid == 0:
+            return
+        with visited_lock:
+            if fid in visited_families:
+                return
+            visited_families.add(fid)
+        work.put(('family', fid))
+
+    def do_family(fid):
+        family = _fetch_family(fid, tree)
+        if family is None:
+            return
+
+        # children go on the stack first so the spouses come off first
+        for child_id in family.get_children():
+            if child_id is not None and child_id != 0:
+                work.put(('child', child_id))
+        for spouse_id in (family.get_wife(), family.get_husband()):
+            if spouse_id is not None and spouse_id != 0:
+                work.put(('spouse', spouse_id))
 
-    with tree_lock:
-        if not tree.does_person_exist(person.get_id()):
-            tree.add_person(person)
+    def do_person(kind, pid):
+        person = _fetch_person(pid, tree)
+        if kind == 'spouse' and person is not None:
+            add_family(person.get_parentid())
 
-    # print(f'Fetched person {person.get_id()}')   # helpful for debugging
-    return person
+    def worker():
+        while True:
+            job = work.get()
+            if job is None:
+                work.task_done()
+                break
+
+            kind, id = job
+            try:
+                if kind == 'family':
+                    do_family(id)
+                else:
+                    do_person(kind, id)
+            finally:
+                work.task_done()
 
+    work.put(('family', family_id))
+
+    threads = []
+    for _ in range(pool_size):
+        t = threading.Thread(target=worker)
+        t.start()
+        threads.append(t)
+
+    # Wait until the stack is empty and every job is done
+    work.join()
+
+    for _ in range(pool_size):
+        work.put(None)
+    for t in threads:
+        t.join()
 
 def depth_fs_pedigree(family_id, tree):
     """
@@ -148,9 +389,25 @@ def depth_fs_pedigree(family_id, tree):
       - fetch the Family from the server
       - fetch husband, wife, and all children (using threads so those API calls overlap)
       - then recursively go to the parents of the husband and wife (DFS).
+
+    With DFS_POOL_SIZE > 0 the search runs on a thread pool (_depth_fs_pool)
+    and the rest of this function is not used.  With DFS_POOL_SIZE = 0 and
+    PREFETCH_FAMILIES the parents' family is prefetched as soon as the
+    husband or wife record arrives (_FamilyPrefetch), so it overlaps with
+    the children's requests.  Both are off by default, they request
+    families out of depth first order.
     """
-    tree_lock = threading.Lock()
+    if DFS_POOL_SIZE > 0:
+        _depth_fs_pool(family_id, tree, DFS_POOL_SIZE)
+        return
+
     visited_families = set()
+    prefetch = _FamilyPrefetch(tree, seen=[family_id])
+
+    def fetch_person(pid, spouse):
+        person = _fetch_person(pid, tree)
+        if spouse:
+            prefetch.reveal_parents(person)
 
     def dfs(current_family_id):
         if current_family_id is None or current_family_id == 0:
@@ -162,7 +419,7 @@ def depth_fs_pedigree(family_id, tree):
         visited_families.add(current_family_id)
 
         # get this family
-        family = _fetch_family(current_family_id, tree, tree_lock)
+        family = _fetch_family(current_family_id, tree)
         if family is None:
             return
 
@@ -170,19 +427,20 @@ def depth_fs_pedigree(family_id, tree):
         husband_id = family.get_husband()
         wife_id = family.get_wife()
 
+        # (id, is a spouse): only the spouses' parents are prefetched
         person_ids = []
         if husband_id is not None and husband_id != 0:
-            person_ids.append(husband_id)
+            person_ids.append((husband_id, True))
         if wife_id is not None and wife_id != 0:
-            person_ids.append(wife_id)
+            person_ids.append((wife_id, True))
         for child_id in family.get_children():
             if child_id is not None and child_id != 0:
-                person_ids.append(child_id)
+                person_ids.append((child_id, False))
 
         # fetch all people for this family in parallel
         threads = []
-        for pid in person_ids:
-            t = threading.Thread(target=_fetch_person, args=(pid, tree, tree_lock))
+        for pid, spouse in person_ids:
+            t = threading.Thread(target=fetch_person, args=(pid, spouse))
             t.start()
             threads.append(t)
 
@@ -190,9 +448,8 @@ def depth_fs_pedigree(family_id, tree):
             t.join()
 
         # now recurse to parents (DFS)
-        with tree_lock:
-            husband = tree.get_person(husband_id) if husband_id else None
-            wife = tree.get_person(wife_id) if wife_id else None
+        husband = tree.get_person(husband_id) if husband_id else None
+        wife = tree.get_person(wife_id) if wife_id else None
 
         parent_family_ids = []
         if husband is not None:
@@ -206,11 +463,11 @@ def depth_fs_pedigree(family_id, tree):
 
     # kick off DFS from the starting family id
     dfs(family_id)
+    prefetch.join()
 # -----------------------------------------------------------------------------
 def breadth_fs_pedigree(family_id, tree):
     # KEEP this function even if you don't implement it
      # Breadth-first retrieval (no recursion) using a queue + worker threads
-    tree_lock = threading.Lock()
     visited_lock = threading.Lock()
 
     family_queue = queue.Queue()
@@ -226,36 +483,19 @@ def breadth_fs_pedigree(family_id, tree):
     def process_family(fid):
         """
         Worker-level logic to process a single family ID:
-        - Fetch the Family
-        - Fetch husband, wife, and children
+        - Fetch the Family with husband, wife, and children in one call
         - Enqueue parents (for BFS) if not visited
         """
-        family = _fetch_family(fid, tree, tree_lock)
+        family = _fetch_family_with_members(fid, tree)
         if family is None:
             return
 
         husband_id = family.get_husband()
         wife_id = family.get_wife()
 
-        # Fetch spouses and children (sequentially here, but in parallel with
-        # other workers because multiple threads are running)
-        person_ids = []
-        if husband_id is not None and husband_id != 0:
-            person_ids.append(husband_id)
-        if wife_id is not None and wife_id != 0:
-            person_ids.append(wife_id)
-
-        for child_id in family.get_children():
-            if child_id is not None and child_id != 0:
-                person_ids.append(child_id)
-
-        for pid in person_ids:
-            _fetch_person(pid, tree, tree_lock)
-
         # After we know spouses, enqueue their parent families (BFS)
-        with tree_lock:
-            husband = tree.get_person(husband_id) if husband_id else None
-            wife = tree.get_person(wife_id) if wife_id else None
+        husband = tree.get_person(husband_id) if husband_id else None
+        wife = tree.get_person(wife_id) if wife_id else None
 
         parent_ids = []
         if husband is not None:
@@ -308,7 +548,6 @@ def breadth_fs_pedigree_limit5(family_id, tree):
     # KEEP this function even if you don't implement it
      # Breadth-first retrieval
     # Limit number of concurrent connections to the FS server to 5
-    tree_lock = threading.Lock()
     visited_lock = threading.Lock()
 
     family_queue = queue.Queue()
@@ -321,46 +560,37 @@ def breadth_fs_pedigree_limit5(family_id, tree):
     # Exactly 5 workers to respect the "limit 5" requirement
     num_workers = 5
 
+    def enqueue_parents(spouse):
+        # Prefetch: queue the spouse's parents' family right away, the other
+        # workers start on it while this one fetches the children
+        if spouse is None:
+            return
+        pfid = spouse.get_parentid()
+        if pfid is None or pfid == 0:
+            return
+        with visited_lock:
+            if pfid not in visited_families:
+                visited_families.add(pfid)
+                family_queue.put(pfid)
+
     def process_family(fid):
-        family = _fetch_family(fid, tree, tree_lock)
+        family = _fetch_family(fid, tree)
         if family is None:
             return
 
         husband_id = family.get_husband()
         wife_id = family.get_wife()
 
-        # Fetch all people in this family
-        person_ids = []
-        if husband_id is not None and husband_id != 0:
-            person_ids.append(husband_id)
-        if wife_id is not None and wife_id != 0:
-            person_ids.append(wife_id)
+        # Fetch all people in this family, spouses first (they have the
+        # parents' families).  Only the spouses' parents are queued, a
+        # family_id would lead down to the descendants.
+        for spouse_id in (husband_id, wife_id):
+            if spouse_id is not None and spouse_id != 0:
+                enqueue_parents(_fetch_person(spouse_id, tree))
 
         for child_id in family.get_children():
             if child_id is not None and child_id != 0:
-                person_ids.append(child_id)
-
-        for pid in person_ids:
-            _fetch_person(pid, tree, tree_lock)
-
-        # Enqueue parents of the spouses (BFS style)
-        with tree_lock:
-            husband = tree.get_person(husband_id) if husband_id else None
-            wife = tree.get_person(wife_id) if wife_id else None
-
-        parent_ids = []
-        if husband is not None:
-            parent_ids.append(husband.get_parentid())
-        if wife is not None:
-            parent_ids.append(wife.get_parentid())
-
-        for pfid in parent_ids:
-            if pfid is None or pfid == 0:
-                continue
-            with visited_lock:
-                if pfid not in visited_families:
-                    visited_families.add(pfid)
-                    family_queue.put(pfid)
+                _fetch_person(child_id, tree)
 
     def worker():
         while True:
@@ -390,4 +620,55 @@ def breadth_fs_pedigree_limit5(family_id, tree):
     #      - Limit number of concurrent connections to the FS server to 5
     # TODO - Printing out people and families that are retrieved from the server will help debugging
 
-    pass
\ No newline at end of file
+    pass
+
+# -----------------------------------------------------------------------------
+ASYNC_IN_FLIGHT = 100   # max requests the async BFS has at the server at once
+
+async def _async_bfs(family_id, tree, max_in_flight):
+    """
+    Every family and person request is its own task, at most max_in_flight
+    of them talk to the server at the same time.  A family's parents are
+    requested as soon as the husband or wife record arrives, while the
+    children of the family are still on their way.
+    """
+    client = set_async_client(max_in_flight)
+    requested_families = {family_id}
+    requested_people = set()
+
+    async def fetch_person(person_id, tasks, is_spouse):
+        data = await get_data_from_server_async(f'{TOP_API_URL}/person/{person_id}')
+        if data is None:
+            return
+
+        person = tree.add_person_if_absent(Person(data))
+
+        # the family this spouse grew up in is the next generation
+        parent_id = person.get_parentid()
+        if is_spouse and parent_id and parent_id not in requested_families:
+            requested_families.add(parent_id)
+            tasks.create_task(fetch_family(parent_id, tasks))
+
+    async def fetch_family(fid, tasks):
+        data = await get_data_from_server_async(f'{TOP_API_URL}/family/{fid}')
+        if data is None:
+            return
+
+        family = tree.add_family_if_absent(Family(data))
+
+        # spouses first, they lead to the parents' families
+        spouses = (family.get_husband(), family.get_wife())
+        for person_id in spouses + family.get_children():
+            if person_id and person_id not in requested_people:
+                requested_people.add(person_id)
+                tasks.create_task(fetch_person(person_id, tasks, person_id in spouses))
+
+    try:
+        async with asyncio.TaskGroup() as tasks:
+            tasks.create_task(fetch_family(family_id, tasks))
+    finally:
+        await client.close()
+
+def breadth_fs_pedigree_async(family_id, tree):
+    # Breadth first retrieval with asyncio tasks instead of threads
+    asyncio.run(_async_bfs(family_id, tree, ASYNC_IN_FLIGHT))
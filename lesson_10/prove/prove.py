@@ -6,16 +6,17 @@ Author: Samantha Mayes
 Purpose: Assignment 10 - Family Search
 """
 from common import *
-from functions import depth_fs_pedigree, breadth_fs_pedigree, breadth_fs_pedigree_limit5
+from functions import depth_fs_pedigree, breadth_fs_pedigree, breadth_fs_pedigree_limit5, breadth_fs_pedigree_async, single_flight
 
 from cse351 import *
 
 DFS = 'Depth First Search'
 BFS = 'Breadth First Search'
 BFS5 = 'Breadth First Search limit 5'
+BFS_ASYNC = 'Breadth First Search asyncio'
 
 def run_part(log, start_id, generations, title, func):
-    tree = Tree(start_id)
+    tree = ConcurrentTree(start_id)
 
     get_data_from_server(f'{TOP_API_URL}/start/{generations}')
 
@@ -23,6 +24,7 @@ def run_part(log, start_id, generations, title, func):
     log.write('#' * 45)
     log.start_timer(f'{title}: {generations} generations')
     log.write('#' * 45)
+    single_flight.reset()
     func(start_id, tree)
     total_time = log.stop_timer()
 
@@ -42,6 +44,7 @@ def run_part(log, start_id, generations, title, func):
     log.write(f'Families:   {tree.get_family_count():>10,} | {server_data["families"]:>14,}')
     log.write(f'API Calls            : {server_data["api"]}')
     log.write(f'Max number of threads: {server_data["threads"]}')
+    log.write(f'Coalesced API calls  : {single_flight.coalesced}')
 
 
 def main():
@@ -66,6 +69,8 @@ def main():
                 run_part(log, start_id, generations, BFS, breadth_fs_pedigree)
             elif part_to_run == 3:
                 run_part(log, start_id, generations, BFS5, breadth_fs_pedigree_limit5)
+            elif part_to_run == 4:
+                run_part(log, start_id, generations, BFS_ASYNC, breadth_fs_pedigree_async)
 
 
 if __name__ == '__main__':
@@ -19,11 +19,15 @@ Top level url returns the following
 """
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from http import HTTPStatus
 from socketserver import ThreadingMixIn
 import threading
+import asyncio
 import time
 import json
 import os
+import sys
+import random
 
 TOP_API_URL = 'http://127.0.0.1:8790'
 
@@ -36,75 +40,222 @@ URL_STARSHIPS = "starships"
 
 DELAY = 0.5         # Delay
 
+# Latency profile, how long a request waits before the reply (see pick_delay)
+# Can also be picked when starting the server: python server.py lognormal
+#   constant  : always DELAY
+#   uniform   : DELAY +/- LATENCY_JITTER (a fraction of DELAY)
+#   lognormal : median DELAY with a long tail, LATENCY_SIGMA is the spread
+LATENCY_PROFILES = ('constant', 'uniform', 'lognormal')
+LATENCY = 'constant'
+LATENCY_JITTER = 0.5
+LATENCY_SIGMA = 0.5
+LATENCY_ROUTES = {}     # route ("people", "films", ...) -> delay in seconds used instead of DELAY
+LATENCY_KNEE = 0        # > 0: with more than this many requests in flight,
+LATENCY_SLOWDOWN = 0.1  # each extra one adds this fraction of the delay
+
+# True: serve with asyncio (one thread, see serve_async) instead of a thread
+# per request
+ASYNC_SERVER = False
+
 master_dict = {}
 
+in_flight = 0
+in_flight_lock = threading.Lock()
+
+
+def pick_delay(base, in_flight):
+    # delay in seconds for a request, base is the delay for its route
+    if LATENCY == 'uniform':
+        delay = base * random.uniform(1 - LATENCY_JITTER, 1 + LATENCY_JITTER)
+    elif LATENCY == 'lognormal':
+        delay = base * random.lognormvariate(0, LATENCY_SIGMA)
+    else:
+        delay = base
+
+    if LATENCY_KNEE > 0 and in_flight > LATENCY_KNEE:
+        delay *= 1 + LATENCY_SLOWDOWN * (in_flight - LATENCY_KNEE)
+    return delay
+
+
+def get_delay(path):
+    # path => "/people/1"
+    route = path.strip('/').split('/')[0]
+    return pick_delay(LATENCY_ROUTES.get(route, DELAY), in_flight)
+
+
+def request_started():
+    global in_flight
+    with in_flight_lock:
+        in_flight += 1
+
+
+def request_finished():
+    global in_flight
+    with in_flight_lock:
+        in_flight -= 1
+
+
+def get_reply(path):
+    """
+    Work out the reply to one request (the DELAY is done by the caller).
+    Returns (200, json text) or (404, None)
+    """
+    # check to top level URL
+    if path == '/':
+        reply = '{"people": "http://127.0.0.1:8790/people/", ' + \
+                '"planets": "http://127.0.0.1:8790/planets/", '  + \
+                '"films": "http://127.0.0.1:8790/films/", ' + \
+                '"species": "http://127.0.0.1:8790/species/", ' + \
+                '"vehicles": "http://127.0.0.1:8790/vehicles/", '  + \
+                '"starships": "http://127.0.0.1:8790/starships/"}'
+        return 200, reply
+
+    # remove the ending '/' if found
+    if path[-1] == '/':
+        path = path[:-1]
+
+    request = path[1:]   # "people/1"
+    parts = request.split('/')
+    # print(parts)
+    if len(parts) != 2:
+        return 404, None
+
+    command = parts[0]
+    # Check for valid command
+    if command not in (URL_PEOPLE, URL_PLANETS, URL_FILMS, URL_SPECIES, URL_VEHICLES, URL_STARSHIPS):
+        return 404, None
+
+    # check for valid id
+    id = parts[1]
+    if not id.isnumeric():
+        return 404, None
+
+    key = f'{command}{id}'
+    if key not in master_dict:
+        return 404, None
+
+    return 200, str(master_dict[key]).replace("'", '"')
+
+
 class Handler(BaseHTTPRequestHandler):
 
+    # HTTP/1.1 keeps the connection open so clients can reuse it, every reply
+    # needs a Content-Length for that to work
+    protocol_version = 'HTTP/1.1'
+
+    # headers and body go out as separate writes, with Nagle on the body of
+    # a reply on a kept-alive connection waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
     def do_GET(self):
-        global master_dict
         print(f'Request: {self.path}')
 
         # self.path => "/people/1"
 
-        # delay the reply from the server
-        time.sleep(DELAY)
-
-        # check to top level URL
-        if self.path == '/':
-            reply = '{"people": "http://127.0.0.1:8790/people/", ' + \
-                    '"planets": "http://127.0.0.1:8790/planets/", '  + \
-                    '"films": "http://127.0.0.1:8790/films/", ' + \
-                    '"species": "http://127.0.0.1:8790/species/", ' + \
-                    '"vehicles": "http://127.0.0.1:8790/vehicles/", '  + \
-                    '"starships": "http://127.0.0.1:8790/starships/"}'
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(str.encode(reply))
+        request_started()
+        try:
+            # delay the reply from the server
+            time.sleep(get_delay(self.path))
+
+            status, reply = get_reply(self.path)
+        finally:
+            request_finished()
+
+        if reply == None:
+            self.send_error(status)
         else:
-            # remove the ending '/' if found
-            if self.path[-1] == '/':
-                self.path = self.path[:-1]
-
-            request = self.path[1:]   # "people/1"
-            parts = request.split('/')
-            # print(parts)
-            if len(parts) != 2:
-                self.send_error(404)
-                # self.wfile.write(str.encode('Error 404 - not found'))
-            else:
-                command = parts[0]
-                # Check for valid command
-                if command not in (URL_PEOPLE, URL_PLANETS, URL_FILMS, URL_SPECIES, URL_VEHICLES, URL_STARSHIPS):
-                    self.send_error(404)
-                    # self.wfile.write(str.encode('Error 404 - not found'))
-                else:
-                    # check for valid id
-                    id = parts[1]
-                    if not id.isnumeric():
-                        self.send_error(404)
-                        # self.wfile.write(str.encode('Error 404 - not found'))
-                    else:
-                        key = f'{command}{id}'
-                        if key not in master_dict:
-                            self.send_error(404)
-                            # self.wfile.write(str.encode('Error 404 - not found'))
-                        else:
-                            self.send_response(200)
-                            self.end_headers()
-                            # self.wfile.write(b'Hello world\t' + threading.current_thread().name.encode() + b'\t' + str(threading.active_count()).encode() + b'\n')
-                            js = str(master_dict[key]).replace("'", '"')
-                            # print()
-                            # print(js)
-                            # print()
-                            self.wfile.write(str.encode(js))
+            body = str.encode(reply)
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
 
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+    # idle keep-alive connections should not stop the server from exiting
+    daemon_threads = True
+
+
+# asyncio server: same replies as Handler, but every connection is a task on
+# one event loop and DELAY is an asyncio.sleep, so thousands of requests can
+# wait at the same time without a thread each.
+async def read_request(reader):
+    # Returns (method, path, version, keep_alive), None when the client closed
+    request_line = await reader.readline()
+    if request_line == b'':
+        return None
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+
+    parts = request_line.decode('latin-1').split()
+    while len(parts) < 3:
+        parts.append('HTTP/1.0')
+    method, path, version = parts[:3]
+
+    # HTTP/1.1 keeps the connection open unless told not to, HTTP/1.0 the opposite
+    if version == 'HTTP/1.1':
+        keep_alive = headers.get('connection') != 'close'
+    else:
+        keep_alive = headers.get('connection') == 'keep-alive'
+
+    return method, path, version, keep_alive
+
+
+async def handle_connection(reader, writer):
+    try:
+        keep_alive = True
+        while keep_alive:
+            request = await read_request(reader)
+            if request == None:
+                break
+
+            method, path, version, keep_alive = request
+            if method != 'GET':
+                status, reply = 400, None
+                keep_alive = False
+            else:
+                print(f'Request: {path}')
+                request_started()
+                try:
+                    await asyncio.sleep(get_delay(path))
+                    status, reply = get_reply(path)
+                finally:
+                    request_finished()
+
+            body = b'' if reply == None else str.encode(reply)
+            head = f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+            head += f'Content-Length: {len(body)}\r\n'
+            head += f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+            writer.write(head.encode() + body)
+            await writer.drain()
+
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_async():
+    server = await asyncio.start_server(handle_connection, 'localhost', 8790, backlog=1024)
+    async with server:
+        await server.serve_forever()
 
 
 def run():
     global master_dict
+    global LATENCY
+
+    if len(sys.argv) > 1:
+        if sys.argv[1] not in LATENCY_PROFILES:
+            print(f'Unknown latency profile {sys.argv[1]}, use one of {LATENCY_PROFILES}')
+            return
+        LATENCY = sys.argv[1]
 
     if not os.path.exists('data.json'):
         print('Error the file "data.json" not found')
@@ -123,8 +274,11 @@ def run():
 
     print(f'Star Wars server waiting..... \nURL: {TOP_API_URL}')
 
-    server = ThreadingSimpleServer(('localhost', 8790), Handler)
-    server.serve_forever()
+    if ASYNC_SERVER:
+        asyncio.run(serve_async())
+    else:
+        server = ThreadingSimpleServer(('localhost', 8790), Handler)
+        server.serve_forever()
 
 
 if __name__ == '__main__':
@@ -17,16 +17,53 @@ Open a terminal window and run this program
 *******************  DO NOT MODIFY!!!!  *********************
 *******************  DO NOT MODIFY!!!!  *********************
 
+API
+
+/start/{generations}
+/end
+/person/{id}
+/family/{id}
+/family/{id}?expand=members   (husband, wife and children inlined)
+/people/{id1},{id2},...       (400 for a bad list, 413 for more than MAX_BATCH ids)
+/families/{id1},{id2},...
+/pedigree/{family_id}?depth=N  (ancestor subtree as newline delimited JSON)
+/metrics                        (request counts, latency percentiles, concurrency)
+
+With ADMIT_MAX > 0 at most that many requests are worked on at once, the rest
+wait in a short queue or get a 429/503 reply with a Retry-After header.
+
+With WORKERS > 0 that many server processes share the port (see serve_workers).
+
+With SNAPSHOT_SEED set the tree of each number of generations is built once
+from that seed and saved, later /start calls load it (see load_tree_snapshot).
+
 """
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from http import HTTPStatus
 from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
 import datetime
 import json
 import time
 import random
 import threading
+import queue
+import atexit
+import asyncio
+import bisect
 import ast
+import sys
+import os
+import mmap
+import signal
+import socket
+import struct
+import shutil
+import tempfile
+import multiprocessing
+from array import array
+from collections import deque
 
 hostName = "127.0.0.1"
 serverPort = 8123
@@ -34,6 +71,59 @@ serverPort = 8123
 SLEEP = 0.25
 MAX_GENERATIONS = 6
 
+# Latency profile, how long a request waits before the reply (see pick_delay)
+# Can also be picked when starting the server: python server.py lognormal
+#   constant  : always SLEEP
+#   uniform   : SLEEP +/- LATENCY_JITTER (a fraction of SLEEP)
+#   lognormal : median SLEEP with a long tail, LATENCY_SIGMA is the spread
+LATENCY_PROFILES = ('constant', 'uniform', 'lognormal')
+LATENCY = 'constant'
+LATENCY_JITTER = 0.5
+LATENCY_SIGMA = 0.5
+LATENCY_ROUTES = {}     # route -> delay in seconds used instead of SLEEP
+LATENCY_KNEE = 0        # > 0: with more than this many requests in flight,
+LATENCY_SLOWDOWN = 0.1  # each extra one adds this fraction of the delay
+
+MAX_BATCH = 500         # max number of ids in one /people or /families request
+
+# True:  /start returns at once and families are created the first time they
+#        are requested (see LazyTree)
+# False: /start builds the whole tree before replying
+LAZY_TREE = False
+
+# Family request order shown at /end (see RequestOrder)
+ORDER_MAX = 100_000     # ids kept, later ones are only counted
+ORDER_SAMPLE = 1        # keep every Nth family request
+ORDER_SUMMARY = False   # True: /end shows counts per generation instead of the ids
+
+# True: keep the JSON text of every /person and /family reply, keyed by the
+# encoded id, so a request is a dict lookup.  Replies are added the first
+# time they are sent; trees of up to RESPONSE_CACHE_PREFILL generations have
+# every reply made at the end of build_tree (more would cost a lot of memory)
+RESPONSE_CACHE = True
+RESPONSE_CACHE_PREFILL = 10
+
+# True: serve with asyncio (one thread, see serve_async) instead of a thread
+# per request
+ASYNC_SERVER = False
+
+# int: /start builds the tree from this seed and saves it in SNAPSHOT_FOLDER,
+# later /start calls for the same generations load the file instead.  The
+# encoding of the ids is saved too, so every run sends the same ids.
+SNAPSHOT_SEED = None
+SNAPSHOT_FOLDER = 'snapshots'
+
+# > 0: fork this many server processes that all listen on serverPort and
+# share the tree and the counters (Linux / macOS, see serve_workers).
+# Not with LAZY_TREE, each worker would only know the families it created.
+WORKERS = 0
+
+# Admission control (see Admission), off when ADMIT_MAX is 0
+ADMIT_MAX = 0           # max requests worked on at the same time
+ADMIT_QUEUE = 10        # requests that may wait for a free slot, more get a 429
+ADMIT_WAIT = 5.0        # seconds a request may wait for a slot, then it gets a 503
+ADMIT_RETRY_AFTER = 1   # seconds sent back in the Retry-After header
+
 primes = (5000007787, 5000007797, 5000007799, 5000007811, 5000007823, 5000007829, 5000007877, 5000007899,
             5000007911, 5000007919, 5000007953, 5000007977, 5000007983, 5000008007, 5000008037, 5000008043, 5000008109, 5000008121,
             5000008127, 5000008133, 5000008147, 5000008151, 5000008201, 5000008219, 5000008271, 5000008297, 5000008313, 5000008319,
@@ -73,34 +163,44 @@ surnames = ('Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Miller', 'Davis',
 
 max_thread_count = 0
 call_count = 0
+record_count = 0        # people / families sent back (a batch call sends many)
 thread_count = 0
 lock = threading.Lock()
 
-family_request_order = []
-people = {}
-families = {}
+tree = None             # TreeStore (build_tree) or LazyTree
+person_replies = {}     # encoded id -> bytes of the /person reply (RESPONSE_CACHE)
+family_replies = {}     # encoded id -> bytes of the /family reply (RESPONSE_CACHE)
 generations_created = 0
 
+shared = None           # SharedCounts when running as one of WORKERS processes
+worker_dir = None       # folder of the tree snapshots the workers share
+tree_version = 0        # the shared tree this worker has loaded
+tree_lock = threading.Lock()
+
+# All names in one tuple so a person only stores a one byte index
+names = male_names + female_names
+
+# Birth dates are stored as days since FIRST_BIRTH
+FIRST_BIRTH = datetime.date(1753, 1, 1).toordinal()
+LAST_BIRTH = datetime.date(2020, 1, 1).toordinal()
+
 
 def get_name_male():
-    return random.choice(male_names)
+    return random.randrange(len(male_names))
 
 
 def get_name_female():
-    return random.choice(female_names)
+    return len(male_names) + random.randrange(len(female_names))
 
 def get_surname():
     return random.choice(surnames)
 
 def get_date():
-    start_date = datetime.date(1753, 1, 1)
-    end_date = datetime.date(2020, 1, 1)
+    return random.randrange(LAST_BIRTH - FIRST_BIRTH)
 
-    time_between_dates = end_date - start_date
-    days_between_dates = time_between_dates.days
-    random_number_of_days = random.randrange(days_between_dates)
-    random_date = start_date + datetime.timedelta(days=random_number_of_days)
-    return f'{random_date.day}-{random_date.month}-{random_date.year}'
+def date_to_str(days):
+    date = datetime.date.fromordinal(FIRST_BIRTH + days)
+    return f'{date.day}-{date.month}-{date.year}'
 
 def encode(id: int):
     if id == None:
@@ -114,348 +214,1442 @@ def decode(code: int):
     else:
         return (code ^ PRIME) // ID
 
+# Log levels, lines above LOG_LEVEL are dropped (and not printed)
+LOG_NONE = 0
+LOG_SUMMARY = 1         # /start and /end details
+LOG_REQUESTS = 2        # a few lines for every request
+LOG_LEVEL = LOG_SUMMARY
+
 class Log:
+    """
+    Lines are put on a queue and written by a background thread, a batch
+    at a time with one flush per batch, so request threads never wait on
+    the file.
+    """
+
+    BATCH = 1000
 
-    def __init__(self, filename):
+    def __init__(self, filename, mode='w'):
         super().__init__()
-        self.lock = threading.Lock()
         self.filename = filename
-        self.file = open(filename, 'w')
-
-    def write(self, line):
-        with self.lock:
-            self.file.write(line)
-            self.file.write('\n')
-            self.file.flush()
+        self.file = open(filename, mode)
+        self.lines = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._write_lines, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def enabled(self, level):
+        return level <= LOG_LEVEL
+
+    def write(self, line, level=LOG_SUMMARY):
+        if level <= LOG_LEVEL:
+            self.lines.put(line)
+
+    def _write_lines(self):
+        done = False
+        while not done:
+            batch = [self.lines.get()]
+            while len(batch) < self.BATCH:
+                try:
+                    batch.append(self.lines.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                done = True
+                batch = batch[:batch.index(None)]
+
+            if len(batch) > 0:
+                self.file.write('\n'.join(batch))
+                self.file.write('\n')
+                self.file.flush()
+
+    def close(self):
+        # write what is queued, then close the file
+        if self.writer.is_alive():
+            self.lines.put(None)
+            self.writer.join()
+        self.file.close()
 
     def __del__(self):
-        self.file.close()
+        self.close()
 
 # Global log object
 log = Log('server.log')
 
 # ----------------------------------------------------------------------------
-class Person:
-    
-    def __init__(self, id, name):
+class TreeStore:
+    """
+    People and families stored in parallel arrays indexed by id (index 0 is
+    not used, an id of 0 means "none"). Children of a family are stored in
+    one array, family_children[id] .. family_children[id + 1] is the range
+    for that family.
+    """
+
+    def __init__(self):
         super().__init__()
-        self.id = id
-        self.name = name
-        self.parents = None
-        self.family = None
-        self.birth = get_date()
+        self.person_name = array('B', [0])
+        self.person_birth = array('I', [0])
+        self.person_parents = array('I', [0])
+        self.person_family = array('I', [0])
+
+        self.family_husband = array('I', [0])
+        self.family_wife = array('I', [0])
+        self.family_generation = array('B', [0])    # 0 = starting family
+        self.family_children = array('I', [0, 0])
+        self.children = array('I')
+
+    def add_person(self, name):
+        self.person_name.append(name)
+        self.person_birth.append(get_date())
+        self.person_parents.append(0)
+        self.person_family.append(0)
+        return len(self.person_name) - 1
+
+    def add_family(self, husband, wife, children, generation):
+        id = len(self.family_husband)
+        self.family_husband.append(husband)
+        self.family_wife.append(wife)
+        self.family_generation.append(generation)
+        self.person_family[husband] = id
+        self.person_family[wife] = id
+        for child in children:
+            self.person_parents[child] = id
+        self.children.extend(children)
+        self.family_children.append(len(self.children))
+        return id
+
+    def person_count(self):
+        return len(self.person_name) - 1
+
+    def family_count(self):
+        return len(self.family_husband) - 1
+
+    def has_person(self, id):
+        return id != None and 0 < id < len(self.person_name)
+
+    def has_family(self, id):
+        return id != None and 0 < id < len(self.family_husband)
+
+    def get_husband(self, id):
+        return self.family_husband[id]
+
+    def get_wife(self, id):
+        return self.family_wife[id]
+
+    def get_children(self, id):
+        return self.children[self.family_children[id]:self.family_children[id + 1]]
+
+    def get_generation(self, id):
+        return self.family_generation[id]
+
+    def get_parents(self, person_id):
+        return self.person_parents[person_id]
+
+    def get_person_dict(self, id):
+        person_dict = {}
 
-    def add_birth(self, date_str):
-        self.birth = date_str
+        person_dict["id"] = encode(id)
+        person_dict["name"] = names[self.person_name[id]]
+        person_dict["birth"] = date_to_str(self.person_birth[id])
+        person_dict["parent_id"] = encode(self.person_parents[id] or None)
+        person_dict["family_id"] = encode(self.person_family[id] or None)
 
-    def add_parents(self, id):
-        self.parents = id
+        return person_dict
 
-    def add_family(self, id):
-        self.family = id
+    def get_family_dict(self, id):
+        family_dict = {}
 
-    def get_dict(self):
-        person_dict = {}
-    
-        person_dict["id"] = encode(self.id)
-        person_dict["name"] = self.name
-        person_dict["birth"] = self.birth
-        person_dict["parent_id"] = encode(self.parents)
-        person_dict["family_id"] = encode(self.family)
-    
-        return person_dict
+        family_dict["id"] = encode(id)
+        family_dict["husband_id"] = encode(self.family_husband[id])
+        family_dict["wife_id"] = encode(self.family_wife[id])
+        family_dict["children"] = [encode(child) for child in self.get_children(id)]
 
-    def __str__(self):
-        output  = f'id        : {encode(self.id)}\n'
-        output += f'name       : {self.name}\n'
-        output += f'birth      : {self.birth}\n'
-        output += f'parent id : {encode(self.parents)}\n'
-        output += f'family id : {encode(self.family)}\n'
+        return family_dict
 
-        return output
+    # Snapshot: the arrays in this order, each padded to 8 bytes, after a
+    # header with a magic number, the seed and generations the tree was made
+    # from, the PRIME and ID used to encode ids and the length of every array
+    ARRAYS = (('person_name', 'B'), ('person_birth', 'I'), ('person_parents', 'I'),
+              ('person_family', 'I'), ('family_husband', 'I'), ('family_wife', 'I'),
+              ('family_generation', 'B'), ('family_children', 'I'), ('children', 'I'))
+    SNAPSHOT_MAGIC = b'TRE2'
+    SNAPSHOT_HEADER = struct.Struct(f'<4s4xqqQQ{len(ARRAYS)}Q')
+
+    def write_snapshot(self, file, seed=0, generations=0):
+        lengths = [len(getattr(self, name)) for name, _ in self.ARRAYS]
+        file.write(self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, seed, generations, PRIME, ID, *lengths))
+        for name, _ in self.ARRAYS:
+            data = getattr(self, name).tobytes()
+            file.write(data)
+            file.write(bytes(-len(data) % 8))
+
+    @classmethod
+    def from_snapshot(cls, buffer):
+        # The arrays are read only views of buffer, nothing is copied, so
+        # processes that mmap the same file share one copy of the tree
+        view = memoryview(buffer)
+        magic, seed, generations, prime, id, *lengths = cls.SNAPSHOT_HEADER.unpack_from(view)
+        if magic != cls.SNAPSHOT_MAGIC:
+            raise ValueError('Not a family tree snapshot')
+
+        store = cls.__new__(cls)
+        store.seed = seed
+        store.generations = generations
+        store.prime = prime
+        store.id = id
+        offset = cls.SNAPSHOT_HEADER.size
+        for (name, typecode), length in zip(cls.ARRAYS, lengths):
+            size = length * array(typecode).itemsize
+            setattr(store, name, view[offset:offset + size].cast(typecode))
+            offset += size + (-size % 8)
+        return store
 
-# ----------------------------------------------------------------------------
-class Family:
 
-    def __init__(self, id, husband, wife):
+# ----------------------------------------------------------------------------
+class LazyTree:
+    """
+    Same methods as TreeStore, but a family is only created the first time
+    one of its ids is requested.  Everything about a family comes from a
+    random generator seeded with (seed, family id), so it is the same no
+    matter when or in which order the ids are requested.
+
+    Ids follow a fixed layout so no lookups are needed:
+    - family 1 is the starting family, the parents of the husband of family f
+      are family 2f and the parents of the wife are family 2f + 1
+    - family f owns person ids f * PERSON_SLOTS + slot, slot 0 is the husband,
+      slot 1 the wife and slots 2 and up are the children born into it
+    """
+
+    PERSON_SLOTS = 10       # husband, wife and up to 8 children
+
+    def __init__(self, gens, seed):
         super().__init__()
-        self.id = id
-        self.husband = husband
-        self.wife = wife
-        self.children = []
+        self.gens = gens
+        self.seed = seed
+        self.created = {}       # family id -> (names, births) of its people
+
+    def _create(self, id):
+        # (names, births) of slots 0, 1, 2, ... of family id
+        family = self.created.get(id)
+        if family == None:
+            rand = random.Random(f'{self.seed}:{id}')
+            name_ids = [rand.randrange(len(male_names)),
+                     len(male_names) + rand.randrange(len(female_names))]
+            for i in range(rand.randint(2, 8)):
+                if rand.randint(1, 2) == 1:
+                    name_ids.append(rand.randrange(len(male_names)))
+                else:
+                    name_ids.append(len(male_names) + rand.randrange(len(female_names)))
+            births = [rand.randrange(LAST_BIRTH - FIRST_BIRTH) for name in name_ids]
+            family = (name_ids, births)
+            # two threads may create the same family, both get the same result
+            self.created[id] = family
+        return family
 
-    def add_child(self, id):
-        self.children.append(id)
-        
-    def get_dict(self):
+    def person_count(self):
+        return sum(len(name_ids) for name_ids, births in list(self.created.values()))
+
+    def family_count(self):
+        return len(self.created)
+
+    def has_family(self, id):
+        return id != None and 0 < id < 2 ** self.gens
+
+    def has_person(self, id):
+        if id == None:
+            return False
+        family_id, slot = divmod(id, self.PERSON_SLOTS)
+        return self.has_family(family_id) and slot < len(self._create(family_id)[0])
+
+    def get_husband(self, id):
+        return id * self.PERSON_SLOTS
+
+    def get_wife(self, id):
+        return id * self.PERSON_SLOTS + 1
+
+    def get_children(self, id):
+        name_ids, births = self._create(id)
+        children = [id * self.PERSON_SLOTS + slot for slot in range(2, len(name_ids))]
+        if id > 1:
+            # husband (even id) or wife (odd id) of the family below
+            children.append((id // 2) * self.PERSON_SLOTS + id % 2)
+        return children
+
+    def get_generation(self, id):
+        return id.bit_length() - 1
+
+    def get_parents(self, person_id):
+        family_id, slot = divmod(person_id, self.PERSON_SLOTS)
+        if slot >= 2:
+            return family_id
+        parents = family_id * 2 + slot
+        return parents if self.has_family(parents) else 0
+
+    def get_person_dict(self, id):
+        family_id, slot = divmod(id, self.PERSON_SLOTS)
+        name_ids, births = self._create(family_id)
+
+        person_dict = {}
+
+        person_dict["id"] = encode(id)
+        person_dict["name"] = names[name_ids[slot]]
+        person_dict["birth"] = date_to_str(births[slot])
+        person_dict["parent_id"] = encode(self.get_parents(id) or None)
+        person_dict["family_id"] = encode(family_id if slot < 2 else None)
+
+        return person_dict
+
+    def get_family_dict(self, id):
         family_dict = {}
-    
-        family_dict["id"] = encode(self.id)
-        family_dict["husband_id"] = encode(self.husband)
-        family_dict["wife_id"] = encode(self.wife)
-        ids = []
-        for child in self.children:
-            ids.append(encode(child.id))
-        family_dict["children"] = ids
-    
+
+        family_dict["id"] = encode(id)
+        family_dict["husband_id"] = encode(self.get_husband(id))
+        family_dict["wife_id"] = encode(self.get_wife(id))
+        family_dict["children"] = [encode(child) for child in self.get_children(id)]
+
         return family_dict
 
-    def __str__(self):
-        output  = f'id         : {encode(self.id)}\n'
-        output += f'husband    : {encode(self.husband)}\n'
-        output += f'wife       : {encode(self.wife)}\n'
-        for child in self.children:
-            output += f'  Child    : {encode(child.id)}\n'
 
-        return output
+# ----------------------------------------------------------------------------
+class RequestOrder:
+    """
+    Order that families were requested in.  Keeps at most ORDER_MAX ids
+    (every ORDER_SAMPLE'th request) in an array, and for every request
+    updates the count per generation and how breadth first / depth first
+    the order is:
+    - bfs score: fraction of requests whose generation is the same or
+      higher than the request before it
+    - dfs score: fraction of requests that went exactly one generation up
+      from the request before it
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.ids = array('I')
+        self.count = 0
+        self.generations = array('L')
+        self.last_generation = None
+        self.steps = 0
+        self.bfs_steps = 0
+        self.dfs_steps = 0
+
+    def add(self, id):
+        store = tree
+        generation = None
+        if store != None and store.has_family(id):
+            generation = store.get_generation(id)
+
+        with self.lock:
+            if self.count % ORDER_SAMPLE == 0 and len(self.ids) < ORDER_MAX and 0 <= id < 2 ** 32:
+                self.ids.append(id)
+            self.count += 1
+
+            if generation != None:
+                while len(self.generations) <= generation:
+                    self.generations.append(0)
+                self.generations[generation] += 1
+
+                if self.last_generation != None:
+                    self.steps += 1
+                    if generation >= self.last_generation:
+                        self.bfs_steps += 1
+                    if generation == self.last_generation + 1:
+                        self.dfs_steps += 1
+                self.last_generation = generation
+
+    def bfs_score(self):
+        return round(self.bfs_steps / self.steps, 3) if self.steps > 0 else 0
+
+    def dfs_score(self):
+        return round(self.dfs_steps / self.steps, 3) if self.steps > 0 else 0
+
+    def lines(self):
+        # lines for the /end report
+        lines = []
+        if not ORDER_SUMMARY:
+            lines.append(', '.join(str(id) for id in self.ids))
+            if len(self.ids) * ORDER_SAMPLE < self.count:
+                lines.append(f'({len(self.ids)} of {self.count} requests shown)')
+        for generation, count in enumerate(self.generations):
+            lines.append(f'  Generation {generation:>3}: {count} requests')
+        lines.append(f'  BFS score: {self.bfs_score()}, DFS score: {self.dfs_score()}')
+        return lines
+
+family_request_order = RequestOrder()
 
 
 # ----------------------------------------------------------------------------
 def build_tree(gens):
-    global people
-    global families
+    global tree
     global log
 
-    people = {}
-    families = {}
-
-    next_person_id = 1
-    next_family_id = 1
+    store = TreeStore()
 
-    def _create_family(generation):
-        nonlocal next_person_id
-        nonlocal next_family_id
-        
-        # print(f'Generation: {generation}')
-        # print(f'next person / family: {next_person_id} / {next_family_id}')
-        if generation < 1:
-            return
+    # Families are created breadth first from the starting family.  Each
+    # entry is a person (0 for the starting family) that still needs a
+    # family of parents, and the generation of that family.
+    todo = deque([(0, 0)])
 
-        husband = Person(next_person_id, get_name_male())
-        people[next_person_id] = husband
-        next_person_id += 1
+    while len(todo) > 0:
+        child_of, generation = todo.popleft()
 
-        wife = Person(next_person_id, get_name_female())
-        people[next_person_id] = wife
-        next_person_id += 1
-
-        family = Family(next_family_id, husband.id, wife.id)
-        husband.add_family(next_family_id)
-        wife.add_family(next_family_id)
-        families[next_family_id] = family
-        next_family_id += 1
+        husband = store.add_person(get_name_male())
+        wife = store.add_person(get_name_female())
 
+        children = []
         number_children = random.randint(2, 8)
         for i in range(number_children):
-
             if random.randint(1, 2) == 1:
-                child = Person(next_person_id, get_name_male())
+                children.append(store.add_person(get_name_male()))
             else:
-                child = Person(next_person_id, get_name_female())
+                children.append(store.add_person(get_name_female()))
+
+        if child_of != 0:
+            children.append(child_of)
+
+        store.add_family(husband, wife, children, generation)
+
+        if generation + 1 < gens:
+            todo.append((husband, generation + 1))
+            todo.append((wife, generation + 1))
+
+    tree = store
+    build_response_cache(store, fill=gens <= RESPONSE_CACHE_PREFILL)
+
+    print(f'Number of people  : {store.person_count()}')
+    print(f'Number of families: {store.family_count()}')
+    log.write(f'Number of people  : {store.person_count()}')
+    log.write(f'Number of families: {store.family_count()}')
+
+def snapshot_filename(seed, generations):
+    return os.path.join(SNAPSHOT_FOLDER, f'tree-{seed}-{generations}.bin')
+
+def seed_encoding():
+    # SNAPSHOT_SEED: the encoding comes from the seed too, the same for all
+    # generations.  Called before the server takes requests so the
+    # start_family_id sent by / already matches the saved trees.
+    global PRIME
+    global ID
+
+    rand = random.Random(SNAPSHOT_SEED)
+    PRIME = rand.choice(primes)
+    ID = rand.randint(10000, 10000000)
+
+def load_tree_snapshot(generations):
+    # SNAPSHOT_SEED: load the saved tree, the first time build and save it
+    global tree
+    global PRIME
+    global ID
+
+    filename = snapshot_filename(SNAPSHOT_SEED, generations)
+    if not os.path.exists(filename):
+        seed_encoding()
+        random.seed(SNAPSHOT_SEED)
+        build_tree(generations)
+        random.seed()
+
+        # write under another name first so a reader never sees half a file
+        os.makedirs(SNAPSHOT_FOLDER, exist_ok=True)
+        temp_filename = f'{filename}.{os.getpid()}'
+        with open(temp_filename, 'wb') as f:
+            tree.write_snapshot(f, SNAPSHOT_SEED, generations)
+        os.replace(temp_filename, filename)
+        log.write(f'Saved snapshot {filename}')
+        return
+
+    with open(filename, 'rb') as f:
+        store = TreeStore.from_snapshot(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    PRIME = store.prime
+    ID = store.id
+    tree = store
+    build_response_cache(store, fill=False)
+
+    print(f'Loaded snapshot {filename}')
+    log.write(f'Loaded snapshot {filename}')
+
+def build_response_cache(store, fill):
+    # fill=False: start empty, get_cached_reply() adds replies as they are sent
+    global person_replies
+    global family_replies
 
-            people[next_person_id] = child
-            family.add_child(child)
-            next_person_id += 1
+    people = {}
+    families = {}
+    if RESPONSE_CACHE and fill:
+        for id in range(1, store.person_count() + 1):
+            people[encode(id)] = bytes(json.dumps(store.get_person_dict(id)), "utf8")
+        for id in range(1, store.family_count() + 1):
+            families[encode(id)] = bytes(json.dumps(store.get_family_dict(id)), "utf8")
 
-        if generation > 1:
-            # create parents and recurve calls
-            husband_parents = _create_family(generation - 1)
-            husband.add_parents(husband_parents.id)
-            husband_parents.add_child(husband)
+    person_replies = people
+    family_replies = families
 
-            wife_parents = _create_family(generation - 1)
-            wife.add_parents(wife_parents.id)
-            wife_parents.add_child(wife)
+    
+# ----------------------------------------------------------------------------
+def get_person(id):
+    store = tree
+    if store != None and store.has_person(id):
+        return store.get_person_dict(id)
+    else:
+        return None
 
 
-        # return the family that was created
-        return family
+def get_family(id):
+    store = tree
+    if store != None and store.has_family(id):
+        return store.get_family_dict(id)
+    else:
+        return None
 
-    _create_family(gens)
+def get_family_with_members(id):
+    # Family plus the person records of the husband, wife and children so
+    # a client does not need a /person call for each of them
+    store = tree
+    if store == None or not store.has_family(id):
+        return None
 
-    print(f'Number of people  : {len(people)}')
-    print(f'Number of families: {len(families)}')
-    log.write(f'Number of people  : {len(people)}')
-    log.write(f'Number of families: {len(families)}')
+    family_dict = store.get_family_dict(id)
+    family_dict['members'] = {
+        'husband': store.get_person_dict(store.get_husband(id)),
+        'wife': store.get_person_dict(store.get_wife(id)),
+        'children': [store.get_person_dict(child) for child in store.get_children(id)],
+    }
+    return family_dict
+
+def walk_pedigree(id, depth):
+    # Generator: breadth first walk up the ancestors of family id for
+    # depth generations (0 = all). Yields one dict per family or person.
+    # Grab the current tree so a /start during the walk does not mix trees
+    store = tree
+
+    people_sent = set()
+    current = [id]
+    generation = 1
+    count = 0
+    while len(current) > 0 and (depth < 1 or generation <= depth):
+        next_gen = []
+        for family_id in current:
+            family_request_order.add(family_id)
+
+            family_dict = store.get_family_dict(family_id)
+            family_dict['type'] = 'family'
+            count += 1
+            yield family_dict
+
+            spouses = [store.get_husband(family_id), store.get_wife(family_id)]
+            for person_id in spouses + list(store.get_children(family_id)):
+                if person_id not in people_sent:
+                    people_sent.add(person_id)
+                    person_dict = store.get_person_dict(person_id)
+                    person_dict['type'] = 'person'
+                    count += 1
+                    yield person_dict
+
+            for spouse in spouses:
+                if store.get_parents(spouse) != 0:
+                    next_gen.append(store.get_parents(spouse))
+
+        current = next_gen
+        generation += 1
+
+    add_records(count)
+
+def add_records(count):
+    global record_count
+
+    with lock:
+        record_count += count
+    if shared != None:
+        shared.add(SharedCounts.RECORDS, count)
+
+def get_cached_reply(replies, code, get_item):
+    # bytes of the JSON for encoded id code, None if there is no such record
+    reply = replies.get(code)
+    if reply == None:
+        id = decode(code)
+        data = get_item(id)
+        if data == None:
+            return None
+        reply = bytes(json.dumps(data), "utf8")
+        # other codes can decode to the same id, only keep the real one so
+        # the cache never holds more than one reply per record
+        if RESPONSE_CACHE and code == encode(id):
+            replies[code] = reply
+    return reply
+
+def get_person_reply(code):
+    return get_cached_reply(person_replies, code, get_person)
+
+def get_family_reply(code):
+    return get_cached_reply(family_replies, code, get_family)
+
+def get_batch(codes, get_item_reply):
+    # codes is the comma separated list of encoded ids from the url.
+    # Unknown ids come back as null so the reply lines up with the request.
+    # Returns (status, bytes of the JSON list, decoded ids, number of records found),
+    # status 400 for an empty or bad list and 413 for more than MAX_BATCH ids
+    try:
+        codes = [int(code) for code in codes.split(',')]
+    except:
+        return 400, None, [], 0
+
+    if len(codes) > MAX_BATCH:
+        return 413, None, [], 0
+
+    replies = [get_item_reply(code) for code in codes]
+    found = sum(1 for reply in replies if reply != None)
+    body = b'[' + b', '.join(b'null' if reply == None else reply for reply in replies) + b']'
+    return 200, body, [decode(code) for code in codes], found
 
-    
 # ----------------------------------------------------------------------------
-class Handler(BaseHTTPRequestHandler):
+class Metrics:
+    """
+    Request counts and latency histograms for each route, plus the highest
+    number of requests in flight during each second.  Histograms have fixed
+    buckets and only the last CONCURRENCY_SECONDS are kept, so memory does
+    not grow with the number of requests.
+    """
+
+    # bucket upper bounds in seconds, 0.1 ms to about 100 s, 25% apart
+    BUCKETS = tuple(0.0001 * 1.25 ** i for i in range(63))
+    CONCURRENCY_SECONDS = 600
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.routes = {}        # route -> histogram of latencies
+        self.lock_wait = array('L', [0] * (len(self.BUCKETS) + 1))
+        self.concurrency = deque(maxlen=self.CONCURRENCY_SECONDS)  # [second, max in flight]
 
-    def get_person(self, id):
-        global people
-        if id in people:
-            return people[id].get_dict()
-        else:
+    def _add(self, histogram, seconds):
+        histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def request_started(self, in_flight, lock_wait):
+        second = int(time.time() - self.start_time)
+        with self.lock:
+            self._add(self.lock_wait, lock_wait)
+            if len(self.concurrency) == 0 or self.concurrency[-1][0] != second:
+                self.concurrency.append([second, in_flight])
+            elif self.concurrency[-1][1] < in_flight:
+                self.concurrency[-1][1] = in_flight
+
+    def request_finished(self, route, seconds):
+        with self.lock:
+            if route not in self.routes:
+                self.routes[route] = array('L', [0] * (len(self.BUCKETS) + 1))
+            self._add(self.routes[route], seconds)
+
+    def _summary(self, histogram):
+        # count and percentiles (upper bound of the bucket, in ms)
+        count = sum(histogram)
+        summary = {'count': count}
+        for name, fraction in (('p50_ms', 0.50), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+            target = fraction * count
+            total = 0
+            for index, number in enumerate(histogram):
+                total += number
+                if number > 0 and total >= target:
+                    break
+            bound = self.BUCKETS[min(index, len(self.BUCKETS) - 1)]
+            summary[name] = round(bound * 1000, 3) if count > 0 else None
+        return summary
+
+    def report(self):
+        with self.lock:
+            return {
+                'uptime': round(time.time() - self.start_time, 3),
+                'routes': {route: self._summary(histogram) for route, histogram in self.routes.items()},
+                'lock_wait': self._summary(self.lock_wait),
+                'concurrency': [list(entry) for entry in self.concurrency],
+            }
+
+metrics = Metrics()
+
+# ----------------------------------------------------------------------------
+class Admission:
+    """
+    Caps the requests in flight at ADMIT_MAX.  When all slots are busy up to
+    ADMIT_QUEUE requests wait (at most ADMIT_WAIT seconds) for one to free up.
+    enter() returns None when the request can go on, otherwise the status to
+    reply with: 429 when the wait queue is full, 503 when the wait timed out.
+    A request that got in must call leave() when it is done.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.waiters = deque()      # futures of serve_async requests waiting
+        self.rejected = 0           # 429 replies
+        self.timed_out = 0          # 503 replies
+
+    def _try_enter(self):
+        # call with self.cond held, returns None, 429 or 'wait'
+        if self.active < ADMIT_MAX and self.waiting == 0:
+            self.active += 1
             return None
+        if self.waiting >= ADMIT_QUEUE:
+            self.rejected += 1
+            return 429
+        return 'wait'
 
+    def enter(self):
+        if ADMIT_MAX <= 0:
+            return None
 
-    def get_family(self, id):
-        global families
-        if id in families:
-            return families[id].get_dict()
-        else:
+        with self.cond:
+            status = self._try_enter()
+            if status != 'wait':
+                return status
+
+            self.waiting += 1
+            try:
+                admitted = self.cond.wait_for(lambda: self.active < ADMIT_MAX, ADMIT_WAIT)
+            finally:
+                self.waiting -= 1
+
+            if not admitted:
+                self.timed_out += 1
+                return 503
+            self.active += 1
             return None
- 
-    def do_GET(self):
-        global thread_count
-        global lock
-        global max_thread_count
-        global call_count
-        global family_request_order
-        global log
-        global generations_created
-
-        with lock:
-            thread_count += 1
-            call_count += 1
-            if thread_count > max_thread_count:
-                max_thread_count = thread_count
-            print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
-            log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
 
-        print('- ' * 35)
-        print(f'Request: {self.path}')
+    async def enter_async(self):
+        # same as enter() without blocking the event loop: leave() hands the
+        # slot of a finished request straight to the oldest waiting future
+        if ADMIT_MAX <= 0:
+            return None
 
-        log.write(f'Request: {self.path}')
+        with self.cond:
+            status = self._try_enter()
+            if status != 'wait':
+                return status
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            self.waiting += 1
 
-        if SLEEP > 0:
-            time.sleep(SLEEP)
+        try:
+            await asyncio.wait_for(waiter, ADMIT_WAIT)
+            return None
+        except asyncio.TimeoutError:
+            with self.cond:
+                if waiter.done() and not waiter.cancelled():
+                    # the slot arrived just as the time ran out
+                    return None
+                self.timed_out += 1
+            return 503
+        finally:
+            with self.cond:
+                self.waiting -= 1
+
+    def leave(self):
+        if ADMIT_MAX <= 0:
+            return
 
-        if 'start' in self.path:
-            family_request_order = []
-            parts = self.path.split('/')
-            if len(parts) < 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        with self.cond:
+            # waiters that timed out are already cancelled, skip them
+            while len(self.waiters) > 0:
+                waiter = self.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+            self.active -= 1
+            self.cond.notify()
+
+    def reset_counts(self):
+        with self.cond:
+            self.rejected = 0
+            self.timed_out = 0
+
+    def report(self):
+        with self.cond:
+            return {
+                'max': ADMIT_MAX,
+                'active': self.active,
+                'waiting': self.waiting,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
+
+admission = Admission()
+
+def get_busy_reply(status):
+    # reply for a request turned away by admission, the client should try
+    # again after ADMIT_RETRY_AFTER seconds
+    body = bytes(json.dumps({'status': HTTPStatus(status).phrase, 'retry_after': ADMIT_RETRY_AFTER}), 'utf8')
+    return body, {'Retry-After': str(ADMIT_RETRY_AFTER)}
+
+def get_route(request):
+    # name used for a request in /metrics, same tests as get_reply()
+    path, _, query = request.partition('?')
+    for route in ('metrics', 'start', 'end', 'pedigree', 'people', 'families', 'person'):
+        if route in path:
+            return route
+    if 'family' in path:
+        return 'family?expand' if 'expand' in query else 'family'
+    return '/'
+
+def get_delay(request):
+    # /metrics is for watching the server, it does not pay the SLEEP
+    route = get_route(request)
+    if route == 'metrics':
+        return 0
+    return pick_delay(LATENCY_ROUTES.get(route, SLEEP), thread_count)
+
+def pick_delay(base, in_flight):
+    # delay in seconds for a request, base is the delay for its route
+    if LATENCY == 'uniform':
+        delay = base * random.uniform(1 - LATENCY_JITTER, 1 + LATENCY_JITTER)
+    elif LATENCY == 'lognormal':
+        delay = base * random.lognormvariate(0, LATENCY_SIGMA)
+    else:
+        delay = base
 
-            try:
-                generations = int(parts[-1])
-            except:
-                generations = MAX_GENERATIONS
+    if LATENCY_KNEE > 0 and in_flight > LATENCY_KNEE:
+        delay *= 1 + LATENCY_SLOWDOWN * (in_flight - LATENCY_KNEE)
+    return delay
+
+# ----------------------------------------------------------------------------
+def request_started(request):
+    # Returns the start time, pass it back to request_finished()
+    global thread_count
+    global call_count
+    global max_thread_count
+
+    started = time.perf_counter()
+    if shared != None:
+        load_shared_tree()
+        shared.request_started('metrics' not in request)
+
+    with lock:
+        locked = time.perf_counter()
+        thread_count += 1
+        if 'metrics' not in request:
+            call_count += 1
+        if thread_count > max_thread_count:
+            max_thread_count = thread_count
+        counts = (thread_count, max_thread_count)
+
+    metrics.request_started(counts[0], locked - started)
 
+    if log.enabled(LOG_REQUESTS):
+        print(f'Current: active threads / max count: {counts[0]} / {counts[1]}')
+        print('- ' * 35)
+        print(f'Request: {request}')
+        log.write(f'Current: active threads / max count: {counts[0]} / {counts[1]}', LOG_REQUESTS)
+        log.write(f'Request: {request}', LOG_REQUESTS)
+
+    return started
+
+def request_finished(request, started):
+    global thread_count
+
+    with lock:
+        thread_count -= 1
+    if shared != None:
+        shared.add(SharedCounts.IN_FLIGHT, -1)
+
+    metrics.request_finished(get_route(request), time.perf_counter() - started)
+
+def get_reply(request):
+    """
+    Work out the reply to one request (the delay is done by the caller).
+    Returns (200, bytes of the json), (404, None), (400 or 413, None) for a bad
+    batch, or for /pedigree (200, generator) where the generator yields one
+    dict per line to send.
+    """
+    global thread_count
+    global max_thread_count
+    global call_count
+    global record_count
+    global family_request_order
+    global generations_created
+    global tree
+
+    global metrics
+
+    path, _, query = request.partition('?')
+    params = parse_qs(query)
+
+    if 'metrics' in path:
+        report = metrics.report()
+        report['status'] = 'OK'
+        report['in_flight'] = thread_count
+        report['max_in_flight'] = max_thread_count
+        report['admission'] = admission.report()
+        if shared != None:
+            # the histograms above are for this worker only
+            report['worker'] = os.getpid()
+        json_data = json.dumps(report)
+
+    elif 'start' in path:
+        family_request_order = RequestOrder()
+        parts = path.split('/')
+        if len(parts) < 3:
+            return 404, None
+
+        try:
+            generations = int(parts[-1])
+        except:
+            generations = MAX_GENERATIONS
+
+        generations_created = generations
+        seed = random.randrange(1_000_000_000)
+        if LAZY_TREE:
+            output = f'Lazy family tree with {generations} generations'
+            print(output)
+            log.write(output)
+            tree = LazyTree(generations, seed)
+            build_response_cache(tree, fill=False)
+        else:
             output = f'Creating family tree with {generations} generations...'
             print(output)
             log.write(output)
+            if SNAPSHOT_SEED != None:
+                load_tree_snapshot(generations)
+            else:
+                build_tree(generations)
 
-            generations_created = generations
-            build_tree(generations)
+        if shared != None:
+            publish_tree(generations)
+
+        max_thread_count = 1
+        thread_count = 1
+        call_count = 1
+        record_count = 0
+        metrics = Metrics()
+        admission.reset_counts()
 
-            max_thread_count = 1
-            thread_count = 1
-            call_count = 1
+        json_data = '{"status":"OK"}'
 
-            json_data = '{"status":"OK"}'
+                
+    elif 'end' in path:
+        print('#' * 80)
+        log.write('#' * 80)
 
-                    
-        elif 'end' in self.path:
-            print('#' * 80)
-            log.write('#' * 80)
+        people_count = tree.person_count() if tree != None else 0
+        family_count = tree.family_count() if tree != None else 0
 
-            print(f'Total number of people  : {len(people)}')
-            print(f'Total number of families: {len(families)}')
-            print(f'Number of generations   : {generations_created}')
-            log.write(f'Total number of people  : {len(people)}')
-            log.write(f'Total number of families: {len(families)}')
-            log.write(f'Number of generations   : {generations_created}')
+        print(f'Total number of people  : {people_count}')
+        print(f'Total number of families: {family_count}')
+        print(f'Number of generations   : {generations_created}')
+        log.write(f'Total number of people  : {people_count}')
+        log.write(f'Total number of families: {family_count}')
+        log.write(f'Number of generations   : {generations_created}')
 
 
-            print('Families were requested in this order:')
-            log.write('Families were requested in this order:')
-            
-            output = str(family_request_order)[1:-1]
+        print('Families were requested in this order:')
+        log.write('Families were requested in this order:')
+        
+        for output in family_request_order.lines():
             print(output)
             log.write(output)
 
-            print(f'Total number of API calls: {call_count}')
-            log.write(f'Total number of API calls: {call_count}')
+        if shared != None:
+            # totals of all the workers, the request order and the BFS / DFS
+            # scores are this worker's
+            call_count = shared.get(SharedCounts.CALLS)
+            record_count = shared.get(SharedCounts.RECORDS)
+            max_thread_count = shared.get(SharedCounts.MAX_IN_FLIGHT)
+            print(f'Workers: {WORKERS}')
+            log.write(f'Workers: {WORKERS}')
 
-            print(f'Final thread count (max count): {max_thread_count}')
-            log.write(f'Final thread count (max count): {max_thread_count}')
+        print(f'Total number of API calls: {call_count}')
+        log.write(f'Total number of API calls: {call_count}')
 
-            data_str = '{' + \
-                       f'"status":"OK", "people": {len(people)}, "families": {len(families)}, "api": {call_count}, "threads": {max_thread_count}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
+        print(f'Total number of records sent: {record_count}')
+        log.write(f'Total number of records sent: {record_count}')
 
-            print('#' * 80)
-            log.write('#' * 80)
+        # with the asyncio server this is the max number of requests in flight
+        print(f'Final thread count (max count): {max_thread_count}')
+        log.write(f'Final thread count (max count): {max_thread_count}')
 
-        elif 'person' in self.path or 'family' in self.path:
-            parts = self.path.split('/')
-            # print('****************************')
-            # print(parts)
+        if ADMIT_MAX > 0:
+            counts = admission.report()
+            output = f'Admission: max {ADMIT_MAX}, rejected (429): {counts["rejected"]}, timed out (503): {counts["timed_out"]}'
+            print(output)
+            log.write(output)
 
-            if len(parts) < 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        data_str = '{' + \
+                   f'"status":"OK", "people": {people_count}, "families": {family_count}, "api": {call_count}, "records": {record_count}, "threads": {max_thread_count}, "bfs_score": {family_request_order.bfs_score()}, "dfs_score": {family_request_order.dfs_score()}' + \
+                   '}'
+        json_data = json.dumps(ast.literal_eval(data_str))
 
-            try:
-                id = decode(int(parts[-1]))
-            except:
-                id = None
+        print('#' * 80)
+        log.write('#' * 80)
 
-            if id == None:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+    elif 'pedigree' in path:
+        parts = path.split('/')
 
-            if 'person' in self.path:
-                data = self.get_person(id)
-            else:
-                data = self.get_family(id)
-                family_request_order.append(id)
+        try:
+            id = decode(int(parts[-1]))
+            depth = int(params.get('depth', ['0'])[0])
+        except:
+            id = None
 
+        if len(parts) < 3 or tree == None or not tree.has_family(id):
+            return 404, None
+
+        if log.enabled(LOG_REQUESTS):
+            print(f'Streaming pedigree of family {id}, depth {depth}')
+            log.write(f'Streaming pedigree of family {id}, depth {depth}', LOG_REQUESTS)
+
+        return 200, walk_pedigree(id, depth)
+
+    elif 'people' in path or 'families' in path:
+        # Batch requests: /people/{id1},{id2},... or /families/{id1},{id2},...
+        # One call, one sleep, many records
+        parts = path.split('/')
+
+        if len(parts) < 3:
+            return 404, None
+
+        if 'people' in path:
+            status, json_data, ids, found = get_batch(parts[-1], get_person_reply)
+        else:
+            status, json_data, ids, found = get_batch(parts[-1], get_family_reply)
+            for id in ids:
+                family_request_order.add(id)
+
+        if status != 200:
+            return status, None
+
+        add_records(found)
+
+    elif 'person' in path or 'family' in path:
+        parts = path.split('/')
+        # print('****************************')
+        # print(parts)
+
+        if len(parts) < 3:
+            return 404, None
+
+        try:
+            code = int(parts[-1])
+        except:
+            return 404, None
+
+        members = 0
+        if 'person' in path:
+            json_data = get_person_reply(code)
+        elif 'members' in params.get('expand', []):
+            id = decode(code)
+            data = get_family_with_members(id)
+            family_request_order.add(id)
             if data != None:
-                json_data = json.dumps(data)
+                members = len(data['members']['children']) + 2
+                json_data = bytes(json.dumps(data), "utf8")
             else:
                 json_data = None
         else:
-            start_id = 1 # random.randint(1, 100000)
-            data = {"start_family_id" : encode(start_id)}
-            json_data = json.dumps(data)
-
-        if json_data == None:
-            self.send_response(404)
-            self.send_header("Content-type",  "application/json")
-            self.end_headers()
+            json_data = get_family_reply(code)
+            family_request_order.add(decode(code))
+
+        if json_data != None:
+            add_records(1 + members)
+    else:
+        start_id = 1 # random.randint(1, 100000)
+        data = {"start_family_id" : encode(start_id)}
+        json_data = json.dumps(data)
+
+    if json_data == None:
+        return 404, None
+
+    if isinstance(json_data, str):
+        json_data = bytes(json_data, "utf8")
+
+    if log.enabled(LOG_REQUESTS):
+        print('Sending:', json_data.decode())
+        log.write(f'Sending: {json_data.decode()}', LOG_REQUESTS)
+
+    return 200, json_data
+
+# ----------------------------------------------------------------------------
+class Handler(BaseHTTPRequestHandler):
+
+    # HTTP/1.1 keeps the connection open so clients can reuse it, every reply
+    # needs a Content-Length (or chunked transfer) for that to work
+    protocol_version = 'HTTP/1.1'
+
+    # headers and body go out as separate writes, with Nagle on the body of
+    # a reply on a kept-alive connection waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        # /metrics is never turned away, it is how we watch a busy server
+        if 'metrics' not in self.path:
+            status = admission.enter()
+            if status != None:
+                self.send_busy(status)
+                return
+            try:
+                self.handle_request()
+            finally:
+                admission.leave()
+        else:
+            self.handle_request()
+
+    def handle_request(self):
+        started = request_started(self.path)
+        try:
+            delay = get_delay(self.path)
+            if delay > 0:
+                time.sleep(delay)
+
+            status, data = get_reply(self.path)
+
+            if data == None or isinstance(data, bytes):
+                body = b'' if data == None else data
+                self.send_response(status)
+                self.send_header("Content-type",  "application/json")
+                self.send_header("Content-Length",  str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_stream(data)
+        finally:
+            request_finished(self.path, started)
+
+    def send_busy(self, status):
+        body, headers = get_busy_reply(status)
+        self.send_response(status)
+        self.send_header("Content-type",  "application/json")
+        self.send_header("Content-Length",  str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, items):
+        # Send each item as one line of JSON as soon as it is ready.
+        # HTTP/1.1 clients get chunked transfer, HTTP/1.0 clients see the end
+        # of the reply when the connection closes.
+        chunked = self.request_version == 'HTTP/1.1'
+
+        self.send_response(200)
+        self.send_header("Content-type",  "application/x-ndjson")
+        if chunked:
+            self.send_header("Transfer-Encoding",  "chunked")
         else:
-            print('Sending:', json_data)
-            log.write(f'Sending: {json_data}')
+            self.close_connection = True
+        self.end_headers()
 
-            self.send_response(200)
-            self.send_header("Content-type",  "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(json_data, "utf8"))
+        for item in items:
+            line = bytes(json.dumps(item) + '\n', "utf8")
+            if chunked:
+                self.wfile.write(f'{len(line):X}\r\n'.encode() + line + b'\r\n')
+            else:
+                self.wfile.write(line)
 
-        with lock:
-            thread_count -= 1
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def log_request(self, code='-', size='-'):
+        # the default prints a line to stderr for every request, errors
+        # (log_error) still go to stderr
+        if isinstance(code, HTTPStatus):
+            code = code.value
+        log.write(f'"{self.requestline}" {code} {size}', LOG_REQUESTS)
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+    # idle keep-alive connections should not stop the server from exiting
+    daemon_threads = True
+
+# ----------------------------------------------------------------------------
+# asyncio server: same routes as Handler, but every connection is a task on
+# one event loop and SLEEP is an asyncio.sleep, so thousands of requests can
+# wait at the same time without a thread each.
+
+async def read_request(reader):
+    # Returns (method, path, version, keep_alive), None when the client closed
+    request_line = await reader.readline()
+    if request_line == b'':
+        return None
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+
+    parts = request_line.decode('latin-1').split()
+    while len(parts) < 3:
+        parts.append('HTTP/1.0')
+    method, path, version = parts[:3]
+
+    # HTTP/1.1 keeps the connection open unless told not to, HTTP/1.0 the opposite
+    if version == 'HTTP/1.1':
+        keep_alive = headers.get('connection') != 'close'
+    else:
+        keep_alive = headers.get('connection') == 'keep-alive'
+
+    return method, path, version, keep_alive
+
+async def handle_connection(reader, writer):
+    try:
+        keep_alive = True
+        while keep_alive:
+            request = await read_request(reader)
+            if request == None:
+                break
+
+            method, path, version, keep_alive = request
+            if method != 'GET':
+                await send_async(writer, 400, None, version, False)
+                break
+
+            if 'metrics' in path:
+                keep_alive = await handle_request_async(writer, path, version, keep_alive)
+                continue
+
+            status = await admission.enter_async()
+            if status != None:
+                body, headers = get_busy_reply(status)
+                keep_alive = await send_async(writer, status, body, version, keep_alive, headers)
+                continue
+            try:
+                keep_alive = await handle_request_async(writer, path, version, keep_alive)
+            finally:
+                admission.leave()
+
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def handle_request_async(writer, path, version, keep_alive):
+    # Returns True if the connection can be used for another request
+    started = request_started(path)
+    try:
+        delay = get_delay(path)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if 'start' in path:
+            # building the tree takes a while, keep the loop running
+            status, data = await asyncio.to_thread(get_reply, path)
+        else:
+            status, data = get_reply(path)
+
+        return await send_async(writer, status, data, version, keep_alive)
+    finally:
+        request_finished(path, started)
+
+async def send_async(writer, status, data, version, keep_alive, headers={}):
+    # Returns True if the connection can be used for another request
+    head = f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+    for name, value in headers.items():
+        head += f'{name}: {value}\r\n'
+
+    if data == None or isinstance(data, bytes):
+        body = b'' if data == None else data
+        head += 'Content-type: application/json\r\n'
+        head += f'Content-Length: {len(body)}\r\n'
+        head += f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+        writer.write(head.encode() + body)
+    else:
+        # /pedigree: one line per item, chunked for HTTP/1.1 clients,
+        # HTTP/1.0 clients see the end of the reply when we close
+        chunked = version == 'HTTP/1.1'
+        keep_alive = keep_alive and chunked
+        head += 'Content-type: application/x-ndjson\r\n'
+        if chunked:
+            head += 'Transfer-Encoding: chunked\r\n'
+        head += f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+        writer.write(head.encode())
+        for item in data:
+            line = bytes(json.dumps(item) + '\n', "utf8")
+            if chunked:
+                writer.write(f'{len(line):X}\r\n'.encode() + line + b'\r\n')
+            else:
+                writer.write(line)
+            await writer.drain()
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+
+    await writer.drain()
+    return keep_alive
+
+async def serve_async(reuse_port=False):
+    server = await asyncio.start_server(handle_connection, hostName, serverPort,
+                                        backlog=1024, reuse_port=reuse_port)
+    async with server:
+        await server.serve_forever()
+
+# ----------------------------------------------------------------------------
+# Worker processes: serve_workers() forks WORKERS copies of the server that
+# all listen on serverPort (SO_REUSEPORT lets the kernel spread connections
+# over them).  The tree of a /start is written to a snapshot file that the
+# other workers mmap before their next request, so there is one copy of it
+# in memory.  Counters live in SharedCounts, /metrics and the request order
+# are kept by each worker.
+
+class SharedCounts:
+    """
+    Numbers every worker sees, in shared memory made before the fork.
+    VERSION goes up by one for each /start, GENERATIONS describes that tree.
+    """
+
+    VERSION, GENERATIONS, CALLS, RECORDS, IN_FLIGHT, MAX_IN_FLIGHT = range(6)
+
+    def __init__(self):
+        super().__init__()
+        self.lock = multiprocessing.Lock()
+        self.values = multiprocessing.RawArray('q', 6)
+
+    def get(self, index):
+        return self.values[index]
+
+    def add(self, index, amount):
+        with self.lock:
+            self.values[index] += amount
+
+    def request_started(self, counted):
+        with self.lock:
+            self.values[self.IN_FLIGHT] += 1
+            if counted:
+                self.values[self.CALLS] += 1
+            if self.values[self.IN_FLIGHT] > self.values[self.MAX_IN_FLIGHT]:
+                self.values[self.MAX_IN_FLIGHT] = self.values[self.IN_FLIGHT]
+
+def snapshot_path(version):
+    return os.path.join(worker_dir, f'tree-{version}.bin')
+
+def publish_tree(generations):
+    # /start: share the tree this worker just made with the other workers
+    global tree_version
+
+    with shared.lock:
+        version = shared.values[SharedCounts.VERSION] + 1
+        with open(snapshot_path(version), 'wb') as f:
+            tree.write_snapshot(f)
+        shared.values[SharedCounts.GENERATIONS] = generations
+        shared.values[SharedCounts.CALLS] = 1
+        shared.values[SharedCounts.RECORDS] = 0
+        shared.values[SharedCounts.MAX_IN_FLIGHT] = shared.values[SharedCounts.IN_FLIGHT]
+        shared.values[SharedCounts.VERSION] = version
+
+    # workers that mapped the old file keep it until they move on
+    if os.path.exists(snapshot_path(version - 1)):
+        os.remove(snapshot_path(version - 1))
+    tree_version = version
+
+def load_shared_tree():
+    # Before each request: pick up the tree of a /start in another worker
+    global tree
+    global tree_version
+    global generations_created
+    global PRIME
+    global ID
+
+    if shared.get(SharedCounts.VERSION) == tree_version:
+        return
+
+    with tree_lock:
+        while shared.get(SharedCounts.VERSION) != tree_version:
+            with shared.lock:
+                version = shared.values[SharedCounts.VERSION]
+                generations = shared.values[SharedCounts.GENERATIONS]
+
+            try:
+                with open(snapshot_path(version), 'rb') as f:
+                    store = TreeStore.from_snapshot(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            except FileNotFoundError:
+                # replaced by an even newer /start, try again
+                continue
+
+            # the encoding of the worker that made the tree
+            PRIME = store.prime
+            ID = store.id
+            build_response_cache(store, fill=False)
+            tree = store
+            generations_created = generations
+            tree_version = version
+
+class ReusePortServer(ThreadingSimpleServer):
+    # every worker binds the same port
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+def serve_worker():
+    # runs in the forked process, threads (the log writer) do not survive a fork
+    global log
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log = Log('server.log', mode='a')
+    try:
+        if ASYNC_SERVER:
+            asyncio.run(serve_async(reuse_port=True))
+        else:
+            server = ReusePortServer((hostName, serverPort), Handler)
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.close()
+
+def serve_workers():
+    global shared
+    global worker_dir
+
+    shared = SharedCounts()
+    worker_dir = tempfile.mkdtemp(prefix='family-tree-')
+
+    pids = []
+    for _ in range(WORKERS):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve_worker()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    print(f'{WORKERS} workers: {pids}')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        shutil.rmtree(worker_dir, ignore_errors=True)
 
 if __name__ == '__main__':
     # random.seed(101)
 
-    # for id in people:
-    #     print(people[id])
-    # print('*' * 50)
-    # for id in families:
-    #     print(families[id])
+    if len(sys.argv) > 1:
+        if sys.argv[1] not in LATENCY_PROFILES:
+            print(f'Unknown latency profile {sys.argv[1]}, use one of {LATENCY_PROFILES}')
+            sys.exit(1)
+        LATENCY = sys.argv[1]
+
+    if WORKERS > 0 and LAZY_TREE:
+        # the people, families and scores at /end would only cover one worker
+        print('WORKERS needs LAZY_TREE = False')
+        sys.exit(1)
+
+    if SNAPSHOT_SEED != None:
+        seed_encoding()
 
-    server = ThreadingSimpleServer((hostName, serverPort), Handler)
     print('Starting Family Search server, use <Ctrl-C> or <Command-C> to stop')
     print(f'URL = {hostName}:{serverPort}\n')
-    server.serve_forever()
-
+    if WORKERS > 0:
+        serve_workers()
+    elif ASYNC_SERVER:
+        asyncio.run(serve_async())
+    else:
+        server = ThreadingSimpleServer((hostName, serverPort), Handler)
+        server.serve_forever()